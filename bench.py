@@ -0,0 +1,1152 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+import tracker
+
+
+class FakeQuoteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers the two Google Finance endpoints used by ScripManager
+    """
+    # Keep-alive
+    protocol_version = "HTTP/1.1"
+
+    # Send each response in one write
+    wbufsize = -1
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(parts.query)
+
+        time.sleep(self.server.latency)
+
+        self.server.requests += 1
+
+        if random.random() < self.server.error_rate:
+            # Same status, different shape - what the real feed does under load
+            body = {"error": "try again"}
+        elif parts.path == "/finance":
+            scrips = query["q"][0].split(",")
+            body = {"searchresults": [{"id": self.server.ids[x],
+                                       "e": x.split(":")[0],
+                                       "t": x.split(":")[1]} for x in scrips]}
+        elif parts.path == "/finance/data":
+            ids = query["cid"][0].split(",")
+            rows = []
+
+            for x in ids:
+                exchange, ticker = self.server.scrips[x].split(":")
+                rows.append({"values": ["", "", "1,234.50", "+12.30", "",
+                                        "1.01", "", "", exchange, "", ticker]})
+
+            body = {"company": {"related": {"rows": rows}}}
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps(body)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeQuoteServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Local stand-in for the quote feed, with a fixed per-request latency
+    and a share of malformed responses
+    """
+    daemon_threads = True
+
+    def __init__(self, scrips, latency=0.05, error_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeQuoteHandler)
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.ids = {}
+        self.scrips = {}
+
+        for i, scrip in enumerate(scrips):
+            self.ids[scrip] = str(i)
+            self.scrips[str(i)] = scrip
+
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://%s:%d" % self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def make_scrips(count):
+    """ Synthetic scrip.json contents
+    """
+    return {"SCRIP %05d LTD" % i: "NSE:SCRIP%05d" % i for i in range(count)}
+
+
+def html_cell(value, css_class=None):
+    if css_class:
+        return '<td class="{}">{}</td>'.format(css_class, value or "&nbsp;")
+
+    return "<td>{}</td>".format(value or "&nbsp;")
+
+
+def make_contract_note(trade_date, blocks, is_new_format=False, rng=random):
+    """ Contract Note HTML in the broker's old (COLUMNS) or new (COLUMNS_NEW)
+    layout. blocks is [(title, [(time, quantity, rate, "B" or "S", intraday)])]
+    """
+    columns = tracker.COLUMNS_NEW if is_new_format else tracker.COLUMNS
+    width = len(columns) - 1
+    rows = ["".join(html_cell(x, "xl27boTBL") for x in columns[:-1])]
+
+    def row(**cells):
+        entry = [""] * width
+
+        for index, value in cells.items():
+            entry[int(index[1:])] = value
+
+        rows.append("".join(html_cell(x) for x in entry))
+
+    for title, trades in blocks:
+        row(c4="ISIN : INE{:06d}01".format(rng.randint(0, 999999)))
+
+        for trade_time, quantity, rate, side, intraday in trades:
+            brokerage = round(rate * (0.001 if intraday else 0.004), 4)
+            net_rate = rate + brokerage if side == "B" else rate - brokerage
+            total = round(quantity * net_rate, 2) * (1 if side == "B" else -1)
+
+            cells = {
+                "c0": str(rng.randint(10**6, 10**7)),
+                "c1": trade_time,
+                "c2": str(rng.randint(10**5, 10**6)),
+                "c3": trade_time,
+                "c4": title,
+                "c7": "%.2f" % rate
+            }
+
+            if is_new_format:
+                cells.update(c5=side, c6=str(quantity), c8="%.4f" % brokerage,
+                             c9="%.4f" % net_rate, c10="%.2f" % rate, c11="%.2f" % total)
+            else:
+                cells["c5" if side == "B" else "c6"] = str(quantity)
+                cells.update(c8="%.2f" % (quantity * rate), c9="%.4f" % brokerage,
+                             c10="%.4f" % net_rate, c11="0.00", c13="%.2f" % total)
+
+            row(**cells)
+
+        stt = "c11" if is_new_format else "c12"
+        row(c4="*STT BUY DELIVERY*", **{stt: "%.2f" % rng.random()})
+        row(c4="TOTAL STT", **{stt: "%.2f" % rng.random()})
+
+    charge = "c11" if is_new_format else "c13"
+
+    for name in ["[Transaction Charges]", "Stamp Duty~", "DR. TOTAL", "NET AMOUNT DUE TO US"]:
+        row(c4=name, **{charge: "%.2f" % (rng.random() * 20)})
+
+    return ("<html><body><table><tr><td>TRADE DATE</td><td>{}</td></tr></table>"
+            "<table border=1>\n{}\n</table></body></html>").format(
+                trade_date.strftime("%d/%m/%Y"),
+                "\n".join("<tr>" + x + "</tr>" for x in rows))
+
+
+def make_contract_notes(titles, count, trades_per_note=10, seed=1):
+    """ Write count Contract Notes, half in each layout, and return their names
+    """
+    rng = random.Random(seed)
+    names = sorted(titles)
+    trade_date = datetime.date(2015, 1, 1)
+    filenames = []
+
+    for i in range(count):
+        trade_date += datetime.timedelta(days=rng.randint(1, 3))
+        blocks = []
+        left = trades_per_note
+
+        while left > 0:
+            trades = []
+
+            for k in range(min(left, rng.randint(1, 3))):
+                trades.append(("%02d:%02d:%02d" % (9 + k, rng.randint(0, 59), rng.randint(0, 59)),
+                               rng.randint(1, 50), round(rng.uniform(20, 900), 2),
+                               rng.choice("BS"), rng.random() < 0.1))
+
+            left -= len(trades)
+            blocks.append((rng.choice(names), trades))
+
+        filename = "CN{:05d}.html".format(i)
+
+        with open(filename, "w") as f:
+            f.write(make_contract_note(trade_date, blocks, i % 2 == 1, rng))
+
+        filenames.append(filename)
+
+    return filenames
+
+
+def make_trade_history(titles, count, seed=1, days=3000):
+    """ Crunched transaction history (as in __trades.json) of count trades
+    over days days
+    """
+    rng = random.Random(seed)
+    names = sorted(titles)
+    start = datetime.date(2010, 1, 1).toordinal()
+    held = {}
+    transactions = []
+
+    for i in range(count):
+        title = rng.choice(names)
+        intraday = rng.random() < 0.1
+        quantity = rng.randint(1, 100)
+        rate = round(rng.uniform(20, 900), 2)
+
+        # Mostly long, with the odd short or oversell
+        if held.get(title, 0) < quantity and rng.random() < 0.8:
+            side = "BUY"
+        else:
+            side = rng.choice(["BUY", "SELL", "SELL"])
+
+        if not intraday:
+            held[title] = held.get(title, 0) + (quantity if side == "BUY" else -quantity)
+
+        brokerage = round(rate * (0.0005 if intraday else 0.004), 4)
+        net_rate = rate + brokerage if side == "BUY" else rate - brokerage
+
+        transactions.append({
+            "Brokerage": "%.4f" % brokerage,
+            "Gross Rate": "%.2f" % rate,
+            "Intraday": intraday,
+            "Net Rate": "%.4f" % net_rate,
+            "Quantity": str(quantity),
+            "Scrip": titles[title],
+            "Security": title,
+            "Total": "%.2f" % (quantity * net_rate),
+            "Trade Date": datetime.date.fromordinal(start + i * days // count).isoformat(),
+            "Trade Time": "%02d:%02d:%02d" % (rng.randint(9, 15), rng.randint(0, 59), rng.randint(0, 59)),
+            "Type": side
+        })
+
+    transactions.sort(key=lambda x: (x["Scrip"], x["Trade Date"], x["Trade Time"]))
+    transactions.append({"Type": tracker.MISC_KEY, "Total": round(count * 0.01, 2)})
+
+    return transactions
+
+
+def make_price_history(scrips, days, seed=1):
+    """ Weekday closes of each scrip from 2010-01-01, as load_price_history
+    has them
+    """
+    rng = tracker.numpy.random.RandomState(seed)
+    first = tracker.day_numbers(tracker.numpy.array([20100101]))[0]
+    calendar = tracker.numpy.arange(first, first + days)
+
+    # 1970-01-01 was a Thursday
+    calendar = calendar[(calendar + 3) % 7 < 5]
+    prices = {}
+
+    for scrip in scrips:
+        walk = tracker.numpy.cumsum(rng.normal(0, 0.02, len(calendar)))
+        prices[scrip] = (calendar, tracker.numpy.round(rng.uniform(20, 900) * tracker.numpy.exp(walk), 2))
+
+    return prices
+
+
+# Ledger descriptions, each matching one key of the tracker's description_map
+LEDGER_DESCRIPTIONS = [
+    ("Direct Credit {}", "credit"),
+    ("Bank Payment {}", "debit"),
+    ("To Bill {}", "debit"),
+    ("By Bill {}", "credit"),
+    ("Amc Charges {}", "debit"),
+    ("Delayed Payment Charges {}", "debit"),
+    ("Dividend {}", "credit"),
+    ("Charges Reversed {}", "credit"),
+    ("Refunded Charges {}", "credit"),
+    ("Service Tax On Bill {}", "debit"),
+    ("Stt For Bill {}", "debit"),
+    ("Fund Transfer For Offsetting {}", "debit")
+]
+
+
+def make_ledger(rows, seed=1):
+    """ Ledger HTML (a GenTableBy table in LEDGER_COLUMNS) of rows entries
+    """
+    rng = random.Random(seed)
+    day = datetime.date(2015, 1, 1)
+    balance = 0.0
+    lines = ["".join(html_cell(x) for x in ["", "", "", "", "OPENING BALANCE", "", "", "0.00"])]
+
+    for i in range(rows):
+        day += datetime.timedelta(days=rng.randint(0, 2))
+        description, side = rng.choice(LEDGER_DESCRIPTIONS)
+        amount = round(rng.uniform(1, 20000), 2)
+        balance += amount if side == "debit" else -amount
+
+        lines.append("".join(html_cell(x) for x in [
+            day.strftime("%d/%m/%Y"), "V{}".format(i), "", "",
+            description.format(rng.randint(1, 99999)),
+            "%.2f" % amount if side == "debit" else "",
+            "%.2f" % amount if side == "credit" else "",
+            "%.2f" % balance]))
+
+    return ('<html><body><table id="GenTableBy">\n{}\n</table></body></html>').format(
+        "\n".join("<tr>" + x + "</tr>" for x in lines))
+
+
+def make_ledgers(count, rows, seed=1):
+    """ Write count Ledger files of rows entries each, and return their names
+    """
+    filenames = []
+
+    for i in range(count):
+        filename = "Ledger_{:04d}.html".format(i)
+
+        with open(filename, "w") as f:
+            f.write(make_ledger(rows, seed + i))
+
+        filenames.append(filename)
+
+    return filenames
+
+
+def make_dividends(titles, count, seed=1):
+    """ Dividend file entries (as in dividend*.json) of count payouts
+    """
+    rng = random.Random(seed)
+    names = sorted(titles)
+
+    return [{"Security": rng.choice(names), "Total": "%.2f" % rng.uniform(1, 5000)}
+            for i in range(count)]
+
+
+def make_quotes(titles, seed=1):
+    """ Quotes of every scrip, as --quotes replays them
+    """
+    rng = random.Random(seed)
+
+    return {scrip: {"price": "%.2f" % rng.uniform(20, 900),
+                    "change": "%.2f" % rng.uniform(-20, 20),
+                    "change_percentage": "%.2f" % rng.uniform(-3, 3)}
+            for scrip in sorted(titles.values())}
+
+
+def make_portfolio(titles, seed=1):
+    """ Processed portfolio (as format_tabular gets it) holding every scrip
+    """
+    rng = random.Random(seed)
+    portfolio = {}
+
+    def amount(scale):
+        # Some blank cells, and some losses
+        return 0 if rng.random() < 0.1 else round(rng.uniform(-scale / 4, scale), 2)
+
+    for scrip in sorted(titles.values()):
+        portfolio[scrip] = {
+            "Total Quantity": rng.randint(1, 500),
+            "Total Value": amount(50000),
+            "Average Rate": amount(900),
+            "Market Rate": amount(900),
+            "Market Change": [amount(20), amount(3)],
+            "Current Value": amount(50000),
+            "Profit/Loss": [amount(5000), amount(30)],
+            "Cleared": [amount(5000), amount(30)],
+            "Intraday": [amount(1000), amount(10)],
+            "Dividend": amount(500)
+        }
+
+    return portfolio
+
+
+class Quiet:
+    """ Silence the pipeline's progress output
+    """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+class Workspace:
+    """ Temporary working directory for a benchmark run
+    """
+
+    def __enter__(self):
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp(prefix="tracker-bench-")
+        os.chdir(self.path)
+
+        return self.path
+
+    def __exit__(self, *args):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+
+def bench_quotes(args):
+    """ Wall-clock time of ScripManager.load_prices against the fake feed
+    """
+    row = "{:>8} {:>12} {:>10} {:>8} {:>9} {:>7} {:>10} {:>10}"
+
+    print row.format("Scrips", "Concurrency", "Requests", "Retries",
+                     "Failures", "Stale", "Retrying", "Seconds")
+
+    for count in args.scrips:
+        titles = make_scrips(count)
+
+        with Workspace():
+            json.dump(titles, open("scrip.json", "w"))
+
+            server = FakeQuoteServer(titles.values(), latency=args.latency,
+                                     error_rate=args.error_rate)
+
+            try:
+                for concurrency in args.concurrency:
+                    tracker.QUOTE_CONCURRENCY = concurrency
+                    server.requests = 0
+
+                    if not args.keep_ids and os.path.exists(tracker.SCRIP_ID_FILE):
+                        os.remove(tracker.SCRIP_ID_FILE)
+
+                    provider = tracker.GoogleQuoteProvider(server.url)
+
+                    start = time.time()
+                    manager = tracker.ScripManager(refresh=True, provider=provider)
+                    manager.load_prices(titles.values())
+                    elapsed = time.time() - start
+
+                    stats = provider.stats
+                    stale = sum(1 for x in manager.scrip.values() if x.get('stale'))
+
+                    print row.format(count, concurrency, server.requests, stats.retries,
+                                     stats.failures, stale, "%.3f" % stats.retry_time,
+                                     "%.3f" % elapsed)
+            finally:
+                server.stop()
+
+            # Same prices, replayed from a recording
+            tracker.save_quote_snapshot(manager.get_quotes(), "quotes.json")
+
+            start = time.time()
+            manager = tracker.ScripManager(provider=tracker.SnapshotQuoteProvider("quotes.json"))
+            manager.load_prices(titles.values())
+            elapsed = time.time() - start
+
+            print row.format(count, "replay", 0, 0, 0, 0, "0.000", "%.3f" % elapsed)
+
+
+def bench_parse(args):
+    """ Contract Note import throughput against parser and number of processes
+    """
+    row = "{:>8} {:>8} {:>8} {:>6} {:>10} {:>10}"
+
+    print row.format("Notes", "Trades", "Parser", "Jobs", "Seconds", "Files/s")
+
+    with Workspace():
+        titles = make_scrips(args.scrips)
+        json.dump(titles, open("scrip.json", "w"))
+
+        filenames = make_contract_notes(titles, args.notes, args.trades)
+        tracker.scrip_manager = tracker.ScripManager()
+
+        for parser in args.parser:
+            for jobs in args.jobs:
+                with Quiet():
+                    start = time.time()
+                    imported = tracker.import_cn_files(filenames, jobs, parser)
+                    elapsed = time.time() - start
+
+                assert len(imported) == len(filenames)
+
+                print row.format(args.notes, args.trades, parser, jobs, "%.3f" % elapsed,
+                                 "%.1f" % (args.notes / elapsed))
+
+
+def bench_parity(args):
+    """ Check that every Contract Note parser gives the same entries
+    """
+    failed = []
+
+    with Workspace() as path:
+        filenames = [os.path.join(args.cwd, x) for x in args.files]
+
+        if not filenames:
+            titles = make_scrips(args.scrips)
+            filenames = [os.path.join(path, x)
+                         for x in make_contract_notes(titles, args.notes, args.trades)]
+
+        for filename in filenames:
+            with Quiet():
+                results = {name: parse(filename) for name, parse in tracker.CN_PARSERS.items()}
+
+            if any(x != results["soup"] for x in results.values()):
+                failed.append(filename)
+
+    print "{} of {} notes parse the same with {}".format(
+        len(filenames) - len(failed), len(filenames), ", ".join(sorted(tracker.CN_PARSERS)))
+
+    for filename in failed:
+        print "Different: " + filename
+
+    if failed:
+        sys.exit(1)
+
+
+def bench_trades(args):
+    """ crunch_trades time against trade engine, on synthetic histories
+    """
+    row = "{:>9} {:>7} {:>10} {:>9} {:>11} {:>6}"
+
+    print row.format("Trades", "Scrips", "Engine", "Seconds", "Trades/s", "Same")
+
+    titles = make_scrips(args.scrips)
+
+    for count in args.trades:
+        history = map(tracker.Transaction.from_dict, make_trade_history(titles, count))
+        runs = [(engine, tracker.TRADE_ENGINES[engine]) for engine in args.engine]
+
+        # The numpy engine once the columns are loaded
+        if "numpy" in args.engine:
+            scrips, columns = tracker.trade_columns(history[:-1])
+            misc_total = history[-1].to_dict()["Total"]
+            runs.append(("columns", lambda x: tracker.crunch_columns(scrips, columns, misc_total, {})))
+
+        expected = None
+
+        for engine, crunch in runs:
+            start = time.time()
+            result = crunch(list(history))
+            elapsed = time.time() - start
+
+            if expected is None:
+                expected = result
+
+            print row.format(count, args.scrips, engine, "%.3f" % elapsed,
+                             "%.0f" % (count / elapsed), "yes" if result == expected else "NO")
+
+
+def bench_valuation(args):
+    """ Daily valuation time against years of history and scrips
+    """
+    row = "{:>6} {:>7} {:>9} {:>7} {:>9} {:>9} {:>12}"
+
+    print row.format("Years", "Scrips", "Trades", "Days", "Columns", "Valuate", "Scrip-days/s")
+
+    for years in args.years:
+        for count in args.scrips:
+            days = years * 365
+            titles = make_scrips(count)
+            history = map(tracker.Transaction.from_dict,
+                          make_trade_history(titles, count * args.trades, days=days)[:-1])
+            prices = make_price_history(titles.values(), days)
+
+            start = time.time()
+            scrips, columns = tracker.trade_columns(history)
+            loaded = time.time() - start
+
+            start = time.time()
+            valuation = tracker.valuate(scrips, columns, prices)
+            elapsed = time.time() - start
+
+            print row.format(years, count, len(history), len(valuation["day"]), "%.3f" % loaded,
+                             "%.3f" % elapsed, "%.0f" % (count * len(valuation["day"]) / elapsed))
+
+
+def bench_prices(args):
+    """ Price history import, daily update and range read times
+    """
+    row = "{:>7} {:>6} {:>9} {:>9} {:>10} {:>8} {:>10} {:>10}"
+
+    print row.format("Scrips", "Years", "Rows", "Import", "Rows/s", "Update", "Range (ms)", "Closes")
+
+    for count in args.scrips:
+        for years in args.years:
+            titles = make_scrips(count)
+            scrips = sorted(titles.values())
+            prices = make_price_history(scrips, years * 365)
+
+            with Workspace():
+                with open("prices.csv", "w") as f:
+                    f.write("scrip,date,open,high,low,close,volume\n")
+
+                    for scrip in scrips:
+                        days, closes = prices[scrip]
+
+                        for day, close in zip(days.astype('M8[D]').astype(str).tolist(), closes.tolist()):
+                            f.write("{},{},{},{},{},{},1000\n".format(scrip, day, close, close * 1.01,
+                                                                       close * 0.99, close))
+
+                history = tracker.PriceHistory()
+
+                start = time.time()
+                rows = history.import_csv("prices.csv")
+                imported = time.time() - start
+
+                # A day of fetched quotes
+                quotes = {scrip: {"price": "100.00"} for scrip in scrips}
+
+                start = time.time()
+                history.record(quotes)
+                updated = time.time() - start
+
+                # The last year of each scrip
+                last = int(prices[scrips[0]][0][-1].astype('M8[D]').astype(str).replace("-", ""))
+
+                start = time.time()
+
+                for scrip in scrips:
+                    history.range(scrip, last - 10000, last)
+
+                ranged = (time.time() - start) / count
+
+                start = time.time()
+                history.closes(scrips)
+                closed = time.time() - start
+
+            print row.format(count, years, rows, "%.3f" % imported, "%.0f" % (rows / imported),
+                             "%.4f" % updated, "%.3f" % (ranged * 1000), "%.3f" % closed)
+
+
+def bench_lots(args):
+    """ FIFO tax lot matching time against the average-cost pass
+    """
+    row = "{:>9} {:>7} {:>11} {:>9} {:>11} {:>9} {:>14} {:>14}"
+
+    print row.format("Trades", "Scrips", "Engine", "Seconds", "Trades/s", "Closed", "Short term", "Long term")
+
+    titles = make_scrips(args.scrips)
+
+    for count in args.trades:
+        history = map(tracker.Transaction.from_dict, make_trade_history(titles, count))
+
+        start = time.time()
+        tracker.crunch_trades(list(history))
+        elapsed = time.time() - start
+
+        print row.format(count, args.scrips, "average", "%.3f" % elapsed, "%.0f" % (count / elapsed), "", "", "")
+
+        start = time.time()
+        lots, closed = tracker.match_lots(history[:-1])
+        gains = tracker.tax_split(closed)
+        elapsed = time.time() - start
+
+        print row.format(count, args.scrips, "fifo", "%.3f" % elapsed, "%.0f" % (count / elapsed), len(closed),
+                         "%.0f" % gains["short_term_gain"], "%.0f" % gains["long_term_gain"])
+
+
+def bench_rows(args):
+    """ Per-row throughput of the Contract Note and Ledger row processing
+    """
+    row = "{:>8} {:>9} {:>10} {:>12}"
+
+    print row.format("Input", "Rows", "Seconds", "Rows/s")
+
+    with Workspace():
+        titles = make_scrips(args.scrips)
+        json.dump(titles, open("scrip.json", "w"))
+        tracker.scrip_manager = tracker.ScripManager()
+
+        with Quiet():
+            notes = [tracker.parse_cn_file(x) for x in make_contract_notes(titles, args.notes, args.trades)]
+            ledgers = [tracker.parse_ledger_file(x) for x in make_ledgers(args.ledgers, args.ledger_rows)]
+
+    for name, process, inputs in [("cn", tracker.process_cn_entries, notes),
+                                  ("ledger", tracker.ledger_amounts, ledgers)]:
+        rows = sum(len(x) for x in inputs)
+        start = time.time()
+
+        for i in range(args.repeat):
+            for entries in inputs:
+                process(entries)
+
+        elapsed = (time.time() - start) / args.repeat
+
+        print row.format(name, rows, "%.3f" % elapsed, "%.0f" % (rows / elapsed))
+
+
+def bench_render(args):
+    """ Time to render the portfolio table against its number of rows
+    """
+    row = "{:>8} {:>10} {:>12} {:>10}"
+
+    print row.format("Rows", "Seconds", "Rows/s", "KB")
+
+    for count in args.rows:
+        titles = make_scrips(count)
+
+        with Workspace():
+            json.dump(titles, open("scrip.json", "w"))
+            tracker.scrip_manager = tracker.ScripManager()
+
+            portfolio = make_portfolio(titles)
+
+            # An unbuffered sink, like a terminal
+            terminal = sys.stdout if args.show else open(os.devnull, "w", 0)
+
+            start = time.time()
+
+            for i in range(args.repeat):
+                text = "\n".join(tracker.format_tabular(portfolio)) + "\n"
+
+                terminal.write(text)
+
+                with open("report.txt", "a") as f:
+                    f.write(tracker.ANSI_CODES.sub("", text))
+
+            elapsed = (time.time() - start) / args.repeat
+
+        print row.format(count, "%.4f" % elapsed, "%.0f" % (count / elapsed), len(text) // 1024)
+
+
+def deep_size(objects):
+    """ Bytes held by objects, counting shared ones once
+    """
+    seen = set()
+    size = 0
+    stack = list(objects)
+
+    while stack:
+        item = stack.pop()
+
+        if id(item) in seen:
+            continue
+
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+        elif hasattr(item, "__slots__"):
+            stack.extend(getattr(item, x) for x in item.__slots__)
+
+    return size
+
+
+def bench_records(args):
+    """ Memory and speed of Transaction records against __trades.json dicts
+    """
+    row = "{:>9} {:>8} {:>10} {:>10} {:>10} {:>10} {:>6}"
+
+    print row.format("Trades", "Records", "MB", "Bytes/row", "Load (s)", "Sort (s)", "Same")
+
+    titles = make_scrips(args.scrips)
+
+    for count in args.trades:
+        text = json.dumps(make_trade_history(titles, count))
+
+        start = time.time()
+        entries = json.loads(text)
+        load_time = time.time() - start
+
+        start = time.time()
+        sorted(entries[:-1], key=lambda x: (x["Scrip"], x["Trade Date"], x["Trade Time"]))
+        sort_time = time.time() - start
+
+        size = deep_size(entries)
+
+        print row.format(count, "dict", "%.1f" % (size / 1e6), size // count,
+                         "%.3f" % load_time, "%.3f" % sort_time, "")
+
+        start = time.time()
+        transactions = map(tracker.Transaction.from_dict, json.loads(text))
+        load_time = time.time() - start
+
+        start = time.time()
+        sorted(transactions[:-1], key=tracker.transaction_key)
+        sort_time = time.time() - start
+
+        size = deep_size(transactions)
+        same = [x.to_dict() for x in transactions] == entries
+
+        print row.format(count, "slots", "%.1f" % (size / 1e6), size // count,
+                         "%.3f" % load_time, "%.3f" % sort_time, "yes" if same else "NO")
+
+        del(entries, transactions)
+
+
+def bench_store(args):
+    """ Start-up, append and rebuild times of the trade store and database against __trades.json
+    """
+    row = "{:>9} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}"
+
+    print row.format("Trades", "Storage", "MB", "Start (s)", "Append (s)", "Python (s)", "Numpy (s)")
+
+    titles = make_scrips(args.scrips)
+
+    for count in args.trades:
+        history = make_trade_history(titles, count + args.append)
+        old, new = history[:count], history[count:-1]
+        misc = history[-1]
+
+        with Workspace():
+            # As the tracker had it: load all, then write all back
+            json.dump(old + [misc], open("__trades.json", "w"), indent=2, sort_keys=True)
+
+            start = time.time()
+            transactions = map(tracker.Transaction.from_dict, json.load(open("__trades.json")))
+            load_time = time.time() - start
+
+            start = time.time()
+            misc_entry = transactions.pop()
+            transactions += map(tracker.Transaction.from_dict, new)
+            transactions = sorted(transactions, key=tracker.transaction_key) + [misc_entry]
+            json.dump([x.to_dict() for x in transactions], open("__trades.json", "w"),
+                      indent=2, sort_keys=True)
+            append_time = time.time() - start
+
+            start = time.time()
+            expected = tracker.crunch_trades(list(transactions))
+            python_time = time.time() - start
+
+            print row.format(count, "json", "%.1f" % (os.path.getsize("__trades.json") / 1e6),
+                             "%.3f" % load_time, "%.3f" % append_time, "%.3f" % python_time, "")
+
+            with Quiet():
+                store = tracker.TradeStore()
+                store.import_json(old + [misc])
+                store.commit()
+
+            start = time.time()
+            store = tracker.TradeStore()
+            load_time = time.time() - start
+
+            start = time.time()
+            store.append(sorted(map(tracker.Transaction.from_dict, new), key=tracker.transaction_key),
+                         misc["Total"])
+            store.commit()
+            append_time = time.time() - start
+
+            start = time.time()
+            positions, trades = tracker.rebuild_positions(store, "python")
+            python_time = time.time() - start
+
+            numpy_time = ""
+
+            if tracker.numpy is not None:
+                start = time.time()
+                positions, numpy_trades = tracker.rebuild_positions(store, "numpy")
+                numpy_time = "%.3f" % (time.time() - start)
+
+                assert numpy_trades == expected
+
+            assert trades == expected
+            assert store.export() == [x.to_dict() for x in transactions]
+
+            size = sum(os.path.getsize(x) for x in [store.record_file, store.index_file, store.extra_file,
+                                                    store.meta_file])
+
+            print row.format(count, "store", "%.1f" % (size / 1e6), "%.3f" % load_time,
+                             "%.3f" % append_time, "%.3f" % python_time, numpy_time)
+
+            database = tracker.TradeDatabase()
+            database.import_json(old + [misc])
+            database.commit()
+
+            start = time.time()
+            database = tracker.TradeDatabase()
+            load_time = time.time() - start
+
+            start = time.time()
+            database.append(sorted(map(tracker.Transaction.from_dict, new), key=tracker.transaction_key),
+                            misc["Total"])
+            database.commit()
+            append_time = time.time() - start
+
+            start = time.time()
+            positions, trades = tracker.rebuild_positions(database, "python")
+            python_time = time.time() - start
+
+            numpy_time = ""
+
+            if tracker.numpy is not None:
+                start = time.time()
+                positions, numpy_trades = tracker.rebuild_positions(database, "numpy")
+                numpy_time = "%.3f" % (time.time() - start)
+
+                assert numpy_trades == expected
+
+            assert trades == expected
+            assert database.export() == [x.to_dict() for x in transactions]
+
+            print row.format(count, "sqlite", "%.1f" % (os.path.getsize(tracker.TRADE_DATABASE) / 1e6),
+                             "%.3f" % load_time, "%.3f" % append_time, "%.3f" % python_time, numpy_time)
+
+
+def run_tracker(options):
+    """ Run tracker.py in the current directory, and return its --profile summary
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tracker.py")
+
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call([sys.executable, script, "--quotes", "quotes.json",
+                               "--profile", "profile.json"] + options, stdout=devnull)
+
+    with open("profile.json") as f:
+        return json.load(f)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(args):
+    """ Stage times, throughput and peak memory of whole tracker runs on
+    generated inputs, checked against the last run in the history file
+    """
+    row = "{:>8} {:>6} {:<24} {:>6} {:>9} {:>9} {:>9} {:>12}"
+    history = []
+    results = []
+
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+
+    print row.format("History", "Run", "Stage", "Calls", "Wall (s)", "CPU (s)", "Peak MB", "Throughput")
+
+    titles = make_scrips(args.scrips)
+    options = ["--storage", args.storage, "--engine", args.engine, "-j", str(args.jobs)]
+
+    for count in args.history_trades:
+        scale = {
+            "history": count,
+            "notes": args.notes,
+            "trades": args.trades,
+            "ledgers": args.ledgers,
+            "ledger_rows": args.ledger_rows,
+            "dividends": args.dividends,
+            "scrips": args.scrips,
+            "options": options
+        }
+        # Items each stage goes through in the cold run
+        items = {
+            "import_cn_files": (args.notes, "notes/s"),
+            "parse_cn_file": (args.notes, "notes/s"),
+            "parse_cn_file_fast": (args.notes, "notes/s"),
+            "parse_ledger_file": (args.ledgers * args.ledger_rows, "rows/s"),
+            "crunch_transactions": (args.notes * args.trades, "trades/s"),
+            "crunch_trades": (count + args.notes * args.trades, "trades/s"),
+            "crunch_columns": (count + args.notes * args.trades, "trades/s"),
+            "load_state": (count, "trades/s")
+        }
+
+        with Workspace():
+            json.dump(titles, open("scrip.json", "w"))
+            json.dump(make_quotes(titles), open("quotes.json", "w"))
+            json.dump(make_trade_history(titles, count), open("__trades.json", "w"),
+                      indent=2, sort_keys=True)
+            json.dump(make_dividends(titles, args.dividends), open("dividend_1.json", "w"))
+
+            make_contract_notes(titles, args.notes, args.trades)
+            make_ledgers(args.ledgers, args.ledger_rows)
+
+            # First run takes in everything, the second finds nothing new
+            runs = [("cold", run_tracker(options)), ("warm", run_tracker(options))]
+
+        for run, profile in runs:
+            stages = sorted(profile["stages"].items()) + [("total", dict(profile["total"], calls=1))]
+
+            for name, stats in stages:
+                throughput = ""
+
+                if run == "cold" and name in items:
+                    amount, unit = items[name]
+                    throughput = "{:.0f} {}".format(amount / max(stats["wall"], 1e-6), unit)
+
+                print row.format(count, run, name, stats["calls"], "%.3f" % stats["wall"],
+                                 "%.3f" % stats["cpu"], "%.1f" % (stats["peak_rss_mb"] or 0), throughput)
+
+        results.append({"scale": scale, "runs": dict(runs)})
+
+    # Regressions against the last run at the same scale
+    regressions = []
+
+    for result in results:
+        previous = [x for x in history if x["scale"] == result["scale"]]
+
+        if not previous:
+            continue
+
+        for run, profile in result["runs"].items():
+            old = previous[-1]["runs"].get(run)
+
+            if old is None:
+                continue
+
+            stages = dict(profile["stages"], total=profile["total"])
+            old_stages = dict(old["stages"], total=old["total"])
+
+            for name in sorted(set(stages) & set(old_stages)):
+                wall, old_wall = stages[name]["wall"], old_stages[name]["wall"]
+
+                if wall > old_wall * (1 + args.tolerance) and wall - old_wall > args.min_seconds:
+                    regressions.append("{} trades, {} run, {}: {:.3f}s -> {:.3f}s".format(
+                        result["scale"]["history"], run, name, old_wall, wall))
+
+                old_peak, peak = old_stages[name]["peak_rss_mb"], stages[name]["peak_rss_mb"]
+
+                if old_peak and peak > old_peak * (1 + args.tolerance):
+                    regressions.append("{} trades, {} run, {}: peak {:.1f}MB -> {:.1f}MB".format(
+                        result["scale"]["history"], run, name, old_peak, peak))
+
+    revision = git_revision()
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    for result in results:
+        result.update(revision=revision, time=now)
+
+    tracker.dump_json_atomic(history + results, args.history, indent=2, sort_keys=True)
+
+    if regressions:
+        print "Slower than the last run:"
+        print "\n".join(regressions)
+
+        if args.check:
+            sys.exit(1)
+
+
+def int_list(text):
+    return [int(x) for x in text.split(",")]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tracker benchmarks")
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser("quotes", help=bench_quotes.__doc__.strip())
+    command.add_argument("--scrips", type=int_list, default=[50, 200, 500])
+    command.add_argument("--concurrency", type=int_list, default=[1, 4, 8])
+    command.add_argument("--latency", type=float, default=0.05,
+                         help="seconds per request on the fake feed")
+    command.add_argument("--error-rate", type=float, default=0.0,
+                         help="share of malformed responses from the fake feed")
+    command.add_argument("--keep-ids", action="store_true",
+                         help="reuse the scrip id mapping between runs")
+    command.set_defaults(func=bench_quotes)
+
+    command = commands.add_parser("parse", help=bench_parse.__doc__.strip())
+    command.add_argument("--notes", type=int, default=200)
+    command.add_argument("--trades", type=int, default=20,
+                         help="trades per note")
+    command.add_argument("--scrips", type=int, default=100)
+    command.add_argument("--jobs", type=int_list, default=[1, 2, 4])
+    command.add_argument("--parser", type=lambda x: x.split(","), default=["soup", "lxml"])
+    command.set_defaults(func=bench_parse)
+
+    command = commands.add_parser("parity", help=bench_parity.__doc__.strip())
+    command.add_argument("files", nargs="*",
+                         help="Contract Notes to check (default: generated ones)")
+    command.add_argument("--notes", type=int, default=50)
+    command.add_argument("--trades", type=int, default=50,
+                         help="trades per note")
+    command.add_argument("--scrips", type=int, default=100)
+    command.set_defaults(func=bench_parity, cwd=os.getcwd())
+
+    command = commands.add_parser("trades", help=bench_trades.__doc__.strip())
+    command.add_argument("--trades", type=int_list, default=[100000, 300000, 1000000])
+    command.add_argument("--scrips", type=int, default=500)
+    command.add_argument("--engine", type=lambda x: x.split(","), default=["python", "numpy"])
+    command.set_defaults(func=bench_trades)
+
+    command = commands.add_parser("valuation", help=bench_valuation.__doc__.strip())
+    command.add_argument("--years", type=int_list, default=[1, 5, 10])
+    command.add_argument("--scrips", type=int_list, default=[100, 500])
+    command.add_argument("--trades", type=int, default=200,
+                         help="trades per scrip")
+    command.set_defaults(func=bench_valuation)
+
+    command = commands.add_parser("prices", help=bench_prices.__doc__.strip())
+    command.add_argument("--scrips", type=int_list, default=[100, 500])
+    command.add_argument("--years", type=int_list, default=[1, 10])
+    command.set_defaults(func=bench_prices)
+
+    command = commands.add_parser("lots", help=bench_lots.__doc__.strip())
+    command.add_argument("--trades", type=int_list, default=[100000, 1000000])
+    command.add_argument("--scrips", type=int, default=500)
+    command.set_defaults(func=bench_lots)
+
+    command = commands.add_parser("rows", help=bench_rows.__doc__.strip())
+    command.add_argument("--notes", type=int, default=200)
+    command.add_argument("--trades", type=int, default=20,
+                         help="trades per note")
+    command.add_argument("--ledgers", type=int, default=10)
+    command.add_argument("--ledger-rows", type=int, default=1000)
+    command.add_argument("--scrips", type=int, default=100)
+    command.add_argument("--repeat", type=int, default=5)
+    command.set_defaults(func=bench_rows)
+
+    command = commands.add_parser("render", help=bench_render.__doc__.strip())
+    command.add_argument("--rows", type=int_list, default=[100, 500, 2000])
+    command.add_argument("--repeat", type=int, default=10)
+    command.add_argument("--show", action="store_true",
+                         help="also write the table to the terminal")
+    command.set_defaults(func=bench_render)
+
+    command = commands.add_parser("records", help=bench_records.__doc__.strip())
+    command.add_argument("--trades", type=int_list, default=[100000, 300000])
+    command.add_argument("--scrips", type=int, default=500)
+    command.set_defaults(func=bench_records)
+
+    command = commands.add_parser("store", help=bench_store.__doc__.strip())
+    command.add_argument("--trades", type=int_list, default=[10000, 100000])
+    command.add_argument("--append", type=int, default=200,
+                         help="new trades in the run")
+    command.add_argument("--scrips", type=int, default=500)
+    command.set_defaults(func=bench_store)
+
+    command = commands.add_parser("pipeline", help=bench_pipeline.__doc__.strip().split("\n")[0])
+    command.add_argument("--history-trades", type=int_list, default=[10000, 100000],
+                         help="trades in __trades.json before the run")
+    command.add_argument("--notes", type=int, default=100)
+    command.add_argument("--trades", type=int, default=20,
+                         help="trades per note")
+    command.add_argument("--ledgers", type=int, default=5)
+    command.add_argument("--ledger-rows", type=int, default=500)
+    command.add_argument("--dividends", type=int, default=200)
+    command.add_argument("--scrips", type=int, default=200)
+    command.add_argument("--storage", choices=["files", "sqlite"], default=tracker.STORAGE)
+    command.add_argument("--engine", choices=sorted(tracker.TRADE_ENGINES), default=tracker.TRADE_ENGINE)
+    command.add_argument("-j", "--jobs", type=int, default=1)
+    command.add_argument("--history", default="bench_history.json",
+                         help="file the runs are added to and compared against")
+    command.add_argument("--tolerance", type=float, default=0.2,
+                         help="share a stage may slow down before it counts as a regression")
+    command.add_argument("--min-seconds", type=float, default=0.05,
+                         help="ignore slowdowns smaller than this")
+    command.add_argument("--check", action="store_true",
+                         help="exit with an error on a regression")
+    command.set_defaults(func=bench_pipeline)
+
+    args = parser.parse_args()
+    args.func(args)
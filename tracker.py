@@ -2,10 +2,43 @@
 
 import json
 import glob
+import csv
+import os
+import hashlib
+import tempfile
+import argparse
 import urllib2
+import urlparse
+import httplib
+import socket
+import threading
+import time
+import random
 import re
 import datetime
+import itertools
+import bisect
+import functools
+import contextlib
+import cProfile
+import struct
+import mmap
+import sqlite3
+from array import array
+from collections import deque
+from operator import attrgetter
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from bs4 import BeautifulSoup
+import lxml.html
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import resource
+except ImportError:
+    resource = None
 from termcolor import colored
 import sys
 
@@ -60,403 +93,2564 @@ BROKERAGE_RATE_DELIVERY = 0.002
 EXIT_LOAD_RATE = 0.004
 CAPITAL_GAIN_TAX_RATE = 0.15
 
+# Lots held longer than this many days are long term, with --tax-lots
+LONG_TERM_DAYS = 365
+LONG_TERM_TAX_RATE = 0.10
+
 PREVIOUS_BALANCE = -20000.00
 
 SELL_RECOMMENDATION_CUTOFF = 4.0
 SELL_RECOMMENDATION_RATE = 105.8/100
 
+# Contract Note parser - "soup" (BeautifulSoup) or "lxml" (same output, faster)
+CN_PARSER = "soup"
+
+# Amounts read from each Ledger file, by content
+LEDGER_CACHE_FILE = "__ledgers.json"
+
+# Per-scrip state of crunch_trades, so a run only applies new transactions
+POSITIONS_FILE = "__positions.json"
+
+# Trade history - TRADE_STORE.bin, .idx.N, .extra and .meta.json
+TRADE_STORE = "__trades"
+
+# Where trades, dividends and processed files are kept - "files" (the trade
+# store and JSON files) or "sqlite" (TRADE_DATABASE)
+STORAGE = "files"
+TRADE_DATABASE = "__tracker.db"
+
+# Trade state kept in JSON files, with the "files" storage
+STATE_FILES = ["__processed.json", "__dividends.json"]
+
+# The state files of a run, with the trade count they go with - written before
+# the trade store commits and moved into STATE_FILES after
+STATE_PENDING = "__state.pending.json"
+
+# Files --watch looks at, and how often (seconds)
+WATCH_PATTERNS = ['CN*.htm*', 'Ledger*.htm*', 'misc_trades*.json', 'dividend*.json', 'scrip.json']
+WATCH_INTERVAL = 2
+
+# Engine for whole-history replays - "python" or "numpy" (same output, faster)
+TRADE_ENGINE = "python"
+
+# Report history - a JSON line per run, REPORT_SEGMENT_RUNS runs to a segment
+# file, the last REPORT_SEGMENTS segments kept, with an index by time
+REPORT_HISTORY_DIR = "__reports"
+REPORT_SEGMENT_RUNS = 100
+REPORT_SEGMENTS = 100
+
+# report.txt moves to report.txt.1 (.2 and so on) once it is this big
+REPORT_TEXT_MAX = 1024 * 1024
+REPORT_TEXT_KEEP = 3
+
+# Colour codes - the terminal gets them, report.txt does not
+ANSI_CODES = re.compile(r'\x1b\[[0-9;]*m')
+
+# ------- QUOTES --------- #
+QUOTE_URL = "https://finance.google.com"
+
+# Google only allows 14 scrips per call
+QUOTE_CHUNK_SIZE = 10
+
+# Number of chunk requests in flight at once (1 = one after another)
+QUOTE_CONCURRENCY = 4
+
+# Seconds before a single request is given up
+QUOTE_TIMEOUT = 10
+
+# Attempts per chunk, with exponential backoff (and jitter) in between
+QUOTE_MAX_ATTEMPTS = 4
+QUOTE_BACKOFF_BASE = 0.5
+QUOTE_BACKOFF_MAX = 8.0
+
+# Consecutive failed requests after which the feed is left alone for this run
+QUOTE_BREAKER_THRESHOLD = 5
+
+# Quotes are reused across runs for this many seconds
+QUOTE_CACHE_FILE = "__quotes.json"
+QUOTE_CACHE_TTL = 15 * 60
+
+# Google ids of the scrips in scrip.json
+SCRIP_ID_FILE = "scrip_id.json"
+
+# Daily prices of each scrip, from imports and fetched quotes
+PRICE_DATABASE = "__prices.db"
+
 # ------- GLOBALS --------- #
 dividends = []
 ipo_investment = 0
 
+# Short and long term FIFO gains, with --tax-lots
+tax_gains = None
 
-class Writer:
-    """ Custom class for printing to file
-    """
-    def __init__(self, *writers):
-        self.writers = writers
-
-    def write(self, text):
-        for w in self.writers:
-            w.write(text)
 
+class Profiler:
+    """ Wall-clock and CPU time, calls and peak memory of each stage of a run
 
-class ScripManager:
-    """ Class for managing scrips
+    A stage is a function marked with @stage, or a block in
+    profiler.stage(name). Times of a stage include the stages it calls; a
+    stage called from inside itself is counted once. Peak memory is the
+    process peak RSS when the stage ends, and how much the stage raised it.
+    Nothing is recorded until enable().
     """
 
     def __init__(self):
-        self.title = {}
-        self.scrip = {}
+        self.enabled = False
+        self.stages = {}
+        # Stages running now -> how deep
+        self.running = {}
+        # Stage to run under cProfile
+        self.cprofile_stage = None
+        self.cprofile = None
+
+    def enable(self, cprofile_stage=None):
+        self.enabled = True
+        self.started = (time.time(), self.cpu_time())
+        self.cprofile_stage = cprofile_stage
+
+        if cprofile_stage:
+            self.cprofile = cProfile.Profile()
+
+    @staticmethod
+    def cpu_time():
+        if resource is None:
+            times = os.times()
+            return times[0] + times[1]
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        return usage.ru_utime + usage.ru_stime
+
+    @staticmethod
+    def peak_rss():
+        """ Peak resident memory of the process so far, in MB
+        """
+        if resource is None:
+            return None
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled or self.running.get(name):
+            yield
+            return
+
+        self.running[name] = True
+        profiled = name == self.cprofile_stage
+        peak = self.peak_rss()
+        start = (time.time(), self.cpu_time())
+
+        if profiled:
+            self.cprofile.enable()
 
-        self.load_titles()
-        self.fetch_price()
+        try:
+            yield
+        finally:
+            if profiled:
+                self.cprofile.disable()
+
+            end_peak = self.peak_rss()
+            stats = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0,
+                                                  "peak_rss_mb": None, "peak_rss_growth_mb": 0.0})
+
+            stats["calls"] += 1
+            stats["wall"] += time.time() - start[0]
+            stats["cpu"] += self.cpu_time() - start[1]
+
+            if end_peak is not None:
+                stats["peak_rss_mb"] = max(stats["peak_rss_mb"], end_peak)
+                stats["peak_rss_growth_mb"] += end_peak - peak
+
+            self.running[name] = False
+
+    def summary(self):
+        return {
+            "argv": sys.argv[1:],
+            "total": {
+                "wall": time.time() - self.started[0],
+                "cpu": self.cpu_time() - self.started[1],
+                "peak_rss_mb": self.peak_rss()
+            },
+            "stages": self.stages
+        }
 
-    def get_scrip_from_title(self, title):
-        if title not in self.title:
-            raise Exception("New Scrip! Add to scrip.json! [ {} ]".format(title))
+    def save(self, filename):
+        dump_json_atomic(self.summary(), filename, indent=2, sort_keys=True)
 
-        return self.title[title]
+        if self.cprofile_stage:
+            if self.cprofile_stage in self.stages:
+                self.cprofile.dump_stats(filename + "." + self.cprofile_stage + ".prof")
+            else:
+                print "No stage {} to profile - stages: {}".format(self.cprofile_stage,
+                                                                   ", ".join(sorted(self.stages)))
 
-    def get_title_from_scrip(self, scrip):
-        return self.scrip[scrip]['title']
 
-    def get_price(self, scrip):
-        scrip = self.scrip[scrip]
+profiler = Profiler()
 
-        price = float(scrip['price'])
-        price_change = [
-            float(scrip['change']),
-            float(scrip['change_percentage'])
-        ]
 
-        return (price, price_change)
+def stage(name=None):
+    """ Decorator making a function a stage of the profiler
+    """
+    def decorate(func):
+        stage_name = name or func.__name__
 
-    def load_titles(self):
-        # List of titles
-        self.title = json.load(open("scrip.json"))
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return func(*args, **kwargs)
 
-        for k, v in self.title.items():
-            self.scrip[v] = {'title': k}
+            with profiler.stage(stage_name):
+                return func(*args, **kwargs)
 
-    def fetch_price(self):
-        print "Retrieving market price..."
+        return wrapper
+
+    return decorate
 
-        scrip_list = self.scrip.keys()
 
-        # Get id
-        id_list = []
-        id_url = "https://finance.google.com/finance?output=json&q="
+def write_atomic(filename, write):
+    """ Write a temporary file with write(f) and move it in place
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    handle, temp_name = tempfile.mkstemp(prefix=".tmp-", dir=directory)
 
-        # Google only allows 14 scrips per call
-        chunks = [scrip_list[x:x+10] for x in range(0, len(scrip_list), 10)]
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            write(f)
 
-        for scrips in chunks:
-            url = id_url + ",".join(scrips)
-            response = urllib2.urlopen(url).read()
-            response = json.loads(response)
-            id_list += [x["id"] for x in response["searchresults"]]
+        os.rename(temp_name, filename)
+    except Exception:
+        os.remove(temp_name)
+        raise
 
-        # Get data for id
-        columns = ["0", "1", "l", "c", "2", "cp", "3", "4", "e", "5", "t"]
 
-        data_url = ("https://finance.google.com/finance/data?" +
-                    "output=json&catid=30,31&cid=")
+@stage()
+def dump_json_atomic(data, filename, **kwargs):
+    """ Write JSON to a temporary file and move it in place
+    """
+    write_atomic(filename, lambda f: json.dump(data, f, **kwargs))
 
-        # Google only allows 14 scrips per call
-        chunks = [id_list[x:x+10] for x in range(0, len(id_list), 10)]
 
-        for ids in chunks:
-            url = data_url + ",".join(ids)
+def file_hash(filename):
+    """ SHA-1 of the file contents
+    """
+    digest = hashlib.sha1()
 
-            while True:
-                try:
-                    response = urllib2.urlopen(url).read()
-                    response = json.loads(response)
-                    response = response["company"]["related"]["rows"]
-                    response = [dict(zip(columns, x["values"])) for x in response]
-
-                    # Let's parse
-                    for item in response:
-                        scrip = item['e'] + ':' + item['t']
-
-                        # FIXME : Kludge
-                        if scrip == "BOM:532285":
-                            scrip = "NSE:GEOJITBNPP"
-
-                        self.scrip[scrip]['price'] = item['l'].replace(',', '')
-                        self.scrip[scrip]['change'] = (item['c'].replace(',', '')
-                                                       if item['c']
-                                                       else "0")
-                        self.scrip[scrip]['change_percentage'] = (
-                            item['cp'].replace(',', '')
-                            if item['cp']
-                            else "0"
-                        )
-
-                    break
-                except KeyError:
-                    print "..."
-                    pass
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
 
+    return digest.hexdigest()
 
-def parse_cn_file(filename):
-    """ Get transaction data from Contract Note file
+
+class ProcessedIndex:
+    """ Input files already imported, keyed by content hash
+
+    Size and mtime are checked first, so an unchanged file is never opened.
+    A file with the same content as an imported one counts as imported,
+    whatever its name.
     """
-    print "Processing file: " + filename + "..."
-    html = open(filename).read()
 
-    soup = BeautifulSoup(html, 'lxml')
+    def __init__(self, data=None, files=None, hashes=None):
+        # filename -> {"sha1", "size", "mtime"}
+        self.files = {} if files is None else files
+        # sha1 -> filename
+        self.hashes = {} if hashes is None else hashes
+        # filename -> (size, mtime, sha1) hashed during this run
+        self.seen = {}
+
+        if isinstance(data, dict):
+            for filename, info in data.get("files", {}).items():
+                self.files[filename] = info
+                self.hashes.setdefault(info["sha1"], filename)
+        else:
+            # Old format - list of file names
+            for filename in data or []:
+                if os.path.exists(filename):
+                    self.add(filename)
 
-    trade_date = (soup.find('td',
-                            text=re.compile('TRADE DATE(.*)', re.DOTALL))
-                  .parent
-                  .findAll('td')[1]
-                  .text)
+    def __contains__(self, filename):
+        return self.find(filename) is not None
 
-    table = soup.find("td", class_="xl27boTBL").findParents("table")[0]
+    def signature(self, filename, stat=None):
+        stat = stat or os.stat(filename)
 
-    entries = []
+        seen = self.seen.get(filename)
 
-    # Just read all rows first
-    for row in table.findAll("tr"):
-        entry = []
+        if seen is None or seen[:2] != (stat.st_size, stat.st_mtime):
+            seen = (stat.st_size, stat.st_mtime, file_hash(filename))
+            self.seen[filename] = seen
 
-        for cell in row.findAll("td"):
-            entry.append("".join(c
-                                 for c in (str(unicode(cell.string)
-                                               .encode('ascii', 'ignore'))
-                                           .strip())
-                                 if c not in "*[]~"))
+        return {"size": seen[0], "mtime": seen[1], "sha1": seen[2]}
 
-        # Trade date as last column
-        entry.append(datetime.datetime.strftime(
-            datetime.datetime.strptime(trade_date, '%d/%m/%Y'),
-            '%Y-%m-%d'
-        ))
+    def find(self, filename):
+        """ Name the file was imported under, or None
+        """
+        stat = os.stat(filename)
+        info = self.files.get(filename)
 
-        # Filter
-        if len(entry) > 11 and "".join(entry):
-            entries.append(entry)
+        if info and info["size"] == stat.st_size and info["mtime"] == stat.st_mtime:
+            return filename
 
-    # Delete unwanted entries
-    for entry in reversed(entries):
-        if "NET AMOUNT DUE" not in "".join(entry):
-            entries.pop()
-        else:
-            break
+        signature = self.signature(filename, stat)
+        original = self.hashes.get(signature["sha1"])
 
-    return entries
+        if original is None:
+            return None
 
+        if original != filename:
+            print "Already imported as " + original + ": " + filename
 
-def process_cn_entry(entry, is_new_html_format=False):
-    """ Process a single entry from CN
-    """
-    processed_entry = {}
+        # Remember this name and stat, so it is not opened again
+        self.files[filename] = signature
 
-    if is_new_html_format:
-        processed_entry.update(dict(zip(COLUMNS_NEW, entry)))
-    else:
-        processed_entry.update(dict(zip(COLUMNS, entry)))
+        return original
 
-    if is_new_html_format:
-        processed_entry['Type'] = ("SELL"
-                                   if processed_entry['Buy/Sell'] == 'S'
-                                   else "BUY")
-    else:
-        if 'Sold Qty' in processed_entry and processed_entry['Sold Qty']:
-            processed_entry['Type'] = "SELL"
-            processed_entry['Quantity'] = processed_entry.pop("Sold Qty")
-        elif 'Bought Qty' in processed_entry and processed_entry['Bought Qty']:
-            processed_entry['Type'] = "BUY"
-            processed_entry['Quantity'] = processed_entry.pop("Bought Qty")
+    def imported(self, filename):
+        """ Whether the file was imported under this name, or its content
+        under any name
 
-    # Total is always positive value
-    if(float(processed_entry['Total']) < 0):
-        processed_entry['Total'] = str(abs(float(processed_entry['Total'])))
+        A file that changed since it was imported under this name is not
+        imported again: entries may have been added to it, or it may have
+        been downloaded again.
+        """
+        if filename not in self.files:
+            return filename in self
 
-    # Is this intraday?
-    brokerage_rate = float(processed_entry['Brokerage']) / float(processed_entry['Gross Rate'])
+        if self.find(filename) is None:
+            print "Changed since it was imported, not importing it again: " + filename
 
-    if brokerage_rate < BROKERAGE_RATE_DELIVERY:
-        processed_entry['Intraday'] = True
-    else:
-        processed_entry['Intraday'] = False
+        return True
 
-    processed_entry['Scrip'] = scrip_manager.get_scrip_from_title(processed_entry['Security'])
+    def new_files(self, filenames):
+        """ Files not imported yet, each content only once
+        """
+        selected = {}
 
-    scrap_keys = COLUMNS[:3]
+        for filename in filenames:
+            if self.imported(filename):
+                continue
 
-    if is_new_html_format:
-        scrap_keys += ['Buy/Sell', 'Remarks']
+            # find has hashed it
+            digest = self.seen[filename][2]
 
-    # Scrap
-    processed_entry = {key:value for key,value in processed_entry.items() if not any(k in key for k in scrap_keys) and (key == 'Intraday' or value)}
+            if digest in selected:
+                print "Same as " + selected[digest] + ": " + filename
+                continue
 
-    return processed_entry
+            selected[digest] = filename
 
+        selected = set(selected.values())
 
-def process_cn_entries(entries):
-    """ Process transactions from Contract Notes
-    """
-    is_data = False
-    is_scrip = False
-    is_misc = False
-    is_new_html_format = False
-    item = {}
-    items = []
-    misc = {}
+        return [filename for filename in filenames if filename in selected]
 
-    # Prune empty entries
-    entries = [entry for entry in entries if "".join(entry).strip()]
+    def digest(self, filename):
+        """ SHA-1 of the file, without opening it if it has not changed
+        """
+        stat = os.stat(filename)
+        info = self.files.get(filename)
 
-    # New format?
-    if len(entries[0]) == 14:
-        is_new_html_format = True
+        if info and info["size"] == stat.st_size and info["mtime"] == stat.st_mtime:
+            return info["sha1"]
 
-    for entry in entries:
-        scrap_entries = ['ISIN', 'BUY AVERAGE', 'SELL AVERAGE', 'NET AVERAGE', 'Delivery Total']
+        self.files[filename] = self.signature(filename, stat)
 
-        # Scrap unnecessary entries
-        if any(item in "".join(entry) for item in scrap_entries):
-            continue
+        return self.files[filename]["sha1"]
 
-        # Clean
-        entry = [x.strip() for x in entry]
+    def add(self, filename):
+        signature = self.signature(filename)
 
-        if entry[0] and entry[0].isdigit():
-            is_data = True
+        self.files[filename] = signature
+        self.hashes.setdefault(signature["sha1"], filename)
 
-        if is_data:
-            # Scrip entries start
-            if not is_scrip:
-                is_scrip = True
+    def to_json(self):
+        return {"files": self.files}
 
-                item = process_cn_entry(entry, is_new_html_format)
-            else:
-                # More entries for same scrip
-                if entry[0] and entry[0].isdigit():
-                    next_item = process_cn_entry(entry, is_new_html_format)
 
-                    # Move the first entry as first entry in Trades
-                    if "Trades" not in item:
-                        item = {"Trades": [item]}
+class SqliteMapping:
+    """ A key/value table as a dict - as much of one as ProcessedIndex needs.
+    Values are kept as JSON.
+    """
 
-                    item["Trades"].append(next_item)
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
 
-                    # Let's continue on to next entry
-                    continue
+    def get(self, key, default=None):
+        row = self.db.execute("SELECT value FROM {} WHERE key = ?".format(self.table), (key,)).fetchone()
 
-                col = 11 if is_new_html_format else 12
+        return default if row is None else json.loads(row[0])
 
-                if entry[col]:
-                    item[entry[4].strip("*").strip()] = entry[col]
+    def __getitem__(self, key):
+        value = self.get(key, KeyError)
 
-                # Entries for the scrip are done
-                if "TOTAL STT" in entry[4] or not entry[col]:
-                    is_scrip = False
-                    is_data = False
+        if value is KeyError:
+            raise KeyError(key)
 
-                    # Cleanup
-                    scrap_keys = COLUMNS[:3]
-                    scrap_keys += ['STT SELL DELIVERY', 'STT BUY DELIVERY']
+        return value
 
-                    if is_new_html_format:
-                        scrap_keys += ['Buy/Sell', 'Remarks']
+    def __setitem__(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO {} (key, value) VALUES (?, ?)".format(self.table),
+                        (key, json.dumps(value)))
 
-                    item = {key: value for key, value in item.items() if not any(k in key for k in scrap_keys) and value}
+    def __contains__(self, key):
+        return self.get(key, KeyError) is not KeyError
 
-                    if "TOTAL STT" in item:
-                        item['STT'] = item.pop("TOTAL STT")
+    def setdefault(self, key, value):
+        if key not in self:
+            self[key] = value
 
-                    items.append(item)
+        return self[key]
 
-                    if not entry[col]:
-                        is_misc = True
-        else:
-            if items:
-                is_misc = True
+    def items(self):
+        return [(key, json.loads(value))
+                for key, value in self.db.execute("SELECT key, value FROM {}".format(self.table))]
 
-        # Process MISC entries
-        if is_misc:
-            col = 11 if is_new_html_format else 13
-            if not entry[col - 1] or is_new_html_format:
-                misc[entry[4].strip("*").strip("[]").strip("~").strip()] = entry[col]
 
-        # Maybe there is entries from next Exchange after this?
-        if "NET AMOUNT DUE" in "".join(entry):
-            is_misc = False
+class DividendList:
+    """ Dividends as __dividends.json has them, with their totals by scrip
+    """
 
-    scrap_keys = ['NET AMOUNT DUE TO', 'DR. TOTAL', 'CR. TOTAL']
+    def __init__(self, entries=None):
+        self.items = []
+        # scrip -> total of its entries, added in list order
+        self.totals = {}
 
-    # Misc Charges
-    misc = {key: value for key, value in misc.items() if not any(k in key for k in scrap_keys)}
-    misc['Total'] = sum(float(item) for key, item in misc.items())
-    misc['Type'] = MISC_KEY
-    items.append(misc)
+        self.extend(entries or [])
 
-    return items
+    def __iter__(self):
+        return iter(self.items)
 
+    def extend(self, entries):
+        for entry in entries:
+            self.items.append(entry)
+            self.totals[entry['Scrip']] = self.totals.get(entry['Scrip'], 0) + float(entry["Total"])
 
-def crunch_cn_entries(entries):
-    """ Crunch entries
+    def total(self, scrip):
+        return self.totals.get(scrip, 0)
+
+    def to_json(self):
+        return list(self.items)
+
+
+class DividendTable:
+    """ Dividends in the dividends table of TradeDatabase, with their totals
+    by scrip in dividend_totals
     """
-    crunched_entries = []
 
-    for entry in entries:
-        # Expand multiple trade entries
-        if "Trades" in entry:
-            crunched_entries.extend(entry["Trades"])
-        else:
-            if entry["Type"] == "MISC":
-                misc_entry = {key: value for key, value in entry.items() if key in ["Type", "Total"]}
-                crunched_entries.append(misc_entry)
-            else:
-                crunched_entries.append(entry)
+    def __init__(self, db):
+        self.db = db
 
-    return crunched_entries
+        # Totals of a database from before dividend_totals
+        if not self.db.execute("SELECT 1 FROM dividend_totals LIMIT 1").fetchone():
+            self.add_totals(self.to_json())
 
+    def __iter__(self):
+        return iter(self.to_json())
 
-def crunch_transactions(entries):
-    """ Crunch transactions
+    def extend(self, entries):
+        self.db.executemany("INSERT INTO dividends (scrip, entry) VALUES (?, ?)",
+                            [(entry['Scrip'], json.dumps(entry)) for entry in entries])
+        self.add_totals(entries)
+
+    def add_totals(self, entries):
+        """ Add entries to the totals of their scrips, in order
+        """
+        totals = {}
+
+        for entry in entries:
+            if entry['Scrip'] not in totals:
+                totals[entry['Scrip']] = self.total(entry['Scrip'])
+
+            totals[entry['Scrip']] += float(entry["Total"])
+
+        for scrip, total in totals.items():
+            self.db.execute("DELETE FROM dividend_totals WHERE scrip IS ?", (scrip,))
+            self.db.execute("INSERT INTO dividend_totals (scrip, total) VALUES (?, ?)", (scrip, total))
+
+    def total(self, scrip):
+        row = self.db.execute("SELECT total FROM dividend_totals WHERE scrip IS ?", (scrip,)).fetchone()
+
+        return 0 if row is None else row[0]
+
+    def to_json(self):
+        return [json.loads(entry) for (entry,) in
+                self.db.execute("SELECT entry FROM dividends ORDER BY id")]
+
+
+class QuoteCache:
+    """ Quotes from earlier runs, fresh for QUOTE_CACHE_TTL seconds
     """
-    global ipo_investment
+    keys = ['price', 'change', 'change_percentage']
 
-    crunched_entries = []
+    def __init__(self, filename=QUOTE_CACHE_FILE, ttl=QUOTE_CACHE_TTL):
+        self.filename = filename
+        self.ttl = ttl
 
-    misc_total = 0
+        try:
+            with open(filename) as f:
+                self.quotes = json.load(f)
+        except (IOError, ValueError):
+            self.quotes = {}
 
-    for entry in entries:
-        if entry["Type"] == MISC_KEY:
-            misc_total += entry["Total"]
-        else:
-            if 'STT' in entry:
-                del(entry['STT'])
+    def get(self, scrip, now=None):
+        """ Fresh quote for scrip, or None
+        """
+        if now is None:
+            now = time.time()
 
-            if 'Scrip' not in entry:
-                entry['Scrip'] = scrip_manager.get_scrip_from_title(entry['Security'])
+        quote = self.quotes.get(scrip)
 
-            crunched_entries.append(entry)
+        if quote is None or now - quote['time'] > self.ttl:
+            return None
 
-        # IPOs
-        if "Notes" in entry and entry["Notes"] == "IPO":
-            ipo_investment += float(entry["Total"])
+        return {key: quote[key] for key in self.keys}
 
-    crunched_entries = sorted(crunched_entries, key=lambda k: (k['Scrip'], k['Trade Date'], k['Trade Time']))
+    def last(self, scrip):
+        """ Last known quote for scrip however old, or None
+        """
+        quote = self.quotes.get(scrip)
 
-    crunched_entries.append({"Type": MISC_KEY, "Total": misc_total})
+        if quote is None:
+            return None
 
-    return crunched_entries
+        return {key: quote[key] for key in self.keys}
 
+    def update(self, scrip, quote, now=None):
+        entry = {key: quote[key] for key in self.keys}
+        entry['time'] = time.time() if now is None else now
 
-def calculate_profit(buy_value, sell_value):
-    """ Calculate profit for a trade
+        self.quotes[scrip] = entry
+
+    def save(self):
+        dump_json_atomic(self.quotes, self.filename, separators=(',', ':'))
+
+
+class PriceHistory:
+    """ Daily open, high, low, close and volume of each scrip in SQLite
+
+    Rows are keyed and kept in (scrip, date) order, with dates like
+    20160123, so the days of a scrip in a range are one index range read.
+    The database is opened when it is first needed.
     """
-    profit = sell_value - buy_value
-    profit_percentage = profit / buy_value * 100
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS prices (
+            scrip TEXT NOT NULL,
+            date INTEGER NOT NULL,
+            open REAL,
+            high REAL,
+            low REAL,
+            close REAL,
+            volume REAL,
+            PRIMARY KEY (scrip, date)
+        ){};
+    """.format(" WITHOUT ROWID" if sqlite3.sqlite_version_info >= (3, 8, 2) else "")
+
+    FIELDS = ["open", "high", "low", "close", "volume"]
+
+    DATE = re.compile(r'\d{4}-\d\d-\d\d\Z')
+
+    def __init__(self, filename=PRICE_DATABASE):
+        self.filename = filename
+        self.connection = None
+
+    @property
+    def db(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.filename)
+            self.connection.executescript(self.SCHEMA)
+
+        return self.connection
+
+    @stage("PriceHistory.import_csv")
+    def import_csv(self, filename):
+        """ Add the rows of CSV with scrip, date (YYYY-MM-DD) and close
+        columns, and any of open, high, low and volume. A day already there
+        is replaced. Returns the number of rows.
+        """
+        match = self.DATE.match
+
+        def rows(reader):
+            header = next(reader)
+            scrip = header.index("scrip")
+            date = header.index("date")
+            fields = [header.index(key) if key in header else None for key in self.FIELDS]
+
+            for row in reader:
+                if not match(row[date]):
+                    raise ValueError("Bad date in {}: {}".format(filename, row[date]))
+
+                yield [row[scrip], int(row[date].replace("-", ""))] + \
+                    [float(row[i]) if i is not None and row[i] else None for i in fields]
+
+        with open(filename) as f:
+            with self.db:
+                cursor = self.db.executemany("INSERT OR REPLACE INTO prices (scrip, date, {}) "
+                                             "VALUES (?, ?, ?, ?, ?, ?, ?)".format(", ".join(self.FIELDS)),
+                                             rows(csv.reader(f)))
+
+        return cursor.rowcount
+
+    def record(self, quotes, now=None):
+        """ Take fetched quotes into the rows of the day - the first quote of
+        a day opens it and the last closes it
+        """
+        day = int(time.strftime("%Y%m%d", time.localtime(now)))
+        rows = [(scrip, day, float(quote['price'])) for scrip, quote in quotes.items()
+                if float(quote['price']) > 0]
+
+        # Not an upsert, which needs SQLite 3.24
+        with self.db:
+            self.db.executemany("INSERT OR IGNORE INTO prices (scrip, date, open, high, low, close) "
+                                "VALUES (?1, ?2, ?3, ?3, ?3, ?3)", rows)
+            self.db.executemany("UPDATE prices SET "
+                                "high = max(coalesce(high, ?3), ?3), "
+                                "low = min(coalesce(low, ?3), ?3), "
+                                "close = ?3 "
+                                "WHERE scrip = ?1 AND date = ?2", rows)
+
+    def range(self, scrip, start=None, end=None):
+        """ (date, open, high, low, close, volume) of the days of scrip from
+        start to end (dates like 20160123, both included), in order
+        """
+        return self.db.execute("SELECT date, {} FROM prices WHERE scrip = ? AND date BETWEEN ? AND ? "
+                               "ORDER BY date".format(", ".join(self.FIELDS)),
+                               (scrip, start or 0, end or 99991231)).fetchall()
+
+    def closes(self, scrips, start=None, end=None):
+        """ Closes of scrips from start to end, as load_price_history has
+        them
+        """
+        prices = {}
+
+        for scrip in scrips:
+            rows = self.db.execute("SELECT date, close FROM prices WHERE scrip = ? AND date BETWEEN ? AND ? "
+                                   "AND close IS NOT NULL ORDER BY date",
+                                   (scrip, start or 0, end or 99991231)).fetchall()
+
+            if rows:
+                dates, closes = zip(*rows)
+                prices[scrip] = (day_numbers(numpy.array(dates, dtype=numpy.int64)), numpy.array(closes))
+
+        return prices
+
+
+class UnknownScripError(Exception):
+    """ A security that is not in scrip.json
+    """
+    pass
 
-    return (profit, profit_percentage)
+
+class FeedError(Exception):
+    """ Price feed could not be reached or did not make sense
+    """
+    pass
 
 
-def crunch_trades(transactions):
-    """ Crunch trades
+class FetchStats:
+    """ Counters for the price fetch stage
     """
-    trades = {}
 
-    # Retreive and clean MISC
-    misc_total = transactions[-1]["Total"]
-    del(transactions[-1])
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.skipped = 0
+        self.retry_time = 0.0
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "retry_time": self.retry_time
+        }
 
-    trades[MISC_KEY] = {
-            "Total Value": misc_total
-            }
 
-    for transaction in transactions:
-        scrip = transaction['Scrip']
-        quantity = float(transaction['Quantity'])
-        total = float(transaction["Total"])
+class CircuitBreaker:
+    """ Stop calling the feed after too many consecutive failures
+    """
 
-        # Blank entry
+    def __init__(self, threshold):
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.failures = 0
+
+    @property
+    def is_open(self):
+        return self.failures >= self.threshold
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+
+
+class RetryPolicy:
+    """ Bounded retries with exponential backoff and full jitter
+    """
+    # What a flaky feed looks like
+    errors = (IOError, httplib.HTTPException, ValueError, KeyError)
+
+    def __init__(self, stats, breaker,
+                 max_attempts=QUOTE_MAX_ATTEMPTS,
+                 backoff_base=QUOTE_BACKOFF_BASE,
+                 backoff_max=QUOTE_BACKOFF_MAX):
+        self.stats = stats
+        self.breaker = breaker
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** attempt))
+
+    def call(self, func, *args):
+        """ Call func until it succeeds, raise FeedError when out of attempts
+        """
+        for attempt in range(self.max_attempts):
+            if self.breaker.is_open:
+                if attempt:
+                    self.stats.add(failures=1)
+                else:
+                    self.stats.add(skipped=1)
+
+                raise FeedError("Price feed is down, not trying again")
+
+            if attempt:
+                delay = self.delay(attempt - 1)
+                self.stats.add(retries=1, retry_time=delay)
+                time.sleep(delay)
+
+            start = time.time()
+
+            try:
+                self.stats.add(requests=1)
+                result = func(*args)
+            except self.errors as e:
+                self.stats.add(retry_time=time.time() - start)
+                self.breaker.failure()
+                error = e
+            else:
+                self.breaker.success()
+                return result
+
+        self.stats.add(failures=1)
+        raise FeedError("Giving up after {} attempts: {!r}".format(self.max_attempts, error))
+
+
+class ConnectionPool:
+    """ Keep-alive HTTP connections, one per thread and host
+    """
+
+    def __init__(self, timeout=QUOTE_TIMEOUT):
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def get(self, url):
+        """ GET the url and return the body, reusing an open connection
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        key = (parts.scheme, parts.netloc)
+
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+
+        # A reused connection may have been closed by the server meanwhile,
+        # so give it one more go on a fresh connection
+        for attempt in range(2):
+            connection = self.local.connections.get(key)
+            is_reused = connection is not None
+
+            if not is_reused:
+                connection = self.connect(parts.scheme, parts.netloc)
+                self.local.connections[key] = connection
+
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                del(self.local.connections[key])
+
+                if is_reused and attempt == 0:
+                    continue
+
+                raise
+
+            if response.status != 200:
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, None)
+
+            return body
+
+    def connect(self, scheme, host):
+        if scheme == "https":
+            connection = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(host, timeout=self.timeout)
+
+        with self.lock:
+            self.connections.append(connection)
+
+        return connection
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+
+            self.connections = []
+
+
+def map_concurrent(func, items, concurrency):
+    """ Map func over items with up to concurrency threads, in order
+    """
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(concurrency, len(items)))
+
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def normalize_scrip(scrip):
+    """ Scrip as named in scrip.json
+    """
+    # FIXME : Kludge
+    if scrip == "BOM:532285":
+        scrip = "NSE:GEOJITBNPP"
+
+    return scrip
+
+
+def chunk_list(items, size):
+    """ Split list into chunks of given size
+    """
+    return [items[x:x+size] for x in range(0, len(items), size)]
+
+
+class QuoteProvider:
+    """ Source of market prices
+    """
+    # Worth keeping in the quote cache?
+    cacheable = False
+
+    def __init__(self):
+        # (scrips asked for, seconds taken) for each batch
+        self.latencies = []
+
+    def fetch(self, scrip_list):
+        """ Quotes for the scrips as {scrip: {price, change, change_percentage}}
+        """
+        start = time.time()
+        quotes = self.fetch_quotes(scrip_list)
+        self.latencies.append((len(scrip_list), time.time() - start))
+
+        return quotes
+
+    def fetch_quotes(self, scrip_list):
+        raise NotImplementedError
+
+
+class GoogleQuoteProvider(QuoteProvider):
+    """ Quotes from Google Finance, looked up by Google id
+    """
+    cacheable = True
+
+    def __init__(self, url=None):
+        QuoteProvider.__init__(self)
+        self.url = url
+        self.stats = FetchStats()
+
+    def fetch_quotes(self, scrip_list):
+        url = self.url or QUOTE_URL
+        pool = ConnectionPool()
+        retry = RetryPolicy(self.stats, CircuitBreaker(QUOTE_BREAKER_THRESHOLD))
+
+        def fetch_ids(scrips):
+            try:
+                return retry.call(self.fetch_ids, pool, url, scrips)
+            except FeedError as e:
+                print e
+                return {}
+
+        def fetch_rows(ids):
+            try:
+                return retry.call(self.fetch_rows, pool, url, ids)
+            except FeedError as e:
+                print e
+                return None
+
+        scrip_ids = self.load_ids()
+
+        try:
+            # Get id - only for scrips we have not seen yet
+            unknown = [scrip for scrip in scrip_list if scrip not in scrip_ids]
+
+            for ids in map_concurrent(fetch_ids,
+                                      chunk_list(unknown, QUOTE_CHUNK_SIZE),
+                                      QUOTE_CONCURRENCY):
+                scrip_ids.update(ids)
+
+            id_list = [scrip_ids[scrip] for scrip in scrip_list if scrip in scrip_ids]
+            id_chunks = chunk_list(id_list, QUOTE_CHUNK_SIZE)
+
+            # Get data for id - None for a chunk that failed
+            rows = map_concurrent(fetch_rows, id_chunks, QUOTE_CONCURRENCY)
+        finally:
+            pool.close()
+
+        # Let's parse
+        quotes = {}
+        answered = set()
+
+        for ids, items in zip(id_chunks, rows):
+            if items is None:
+                continue
+
+            answered.update(ids)
+
+            for item in items:
+                scrip, quote = self.parse_row(item)
+                quotes[scrip] = quote
+
+        # Maybe the id is wrong, look it up again next time - not when the
+        # feed did not answer for it
+        for scrip in scrip_list:
+            if scrip not in quotes and scrip_ids.get(scrip) in answered:
+                del scrip_ids[scrip]
+
+        self.save_ids(scrip_ids)
+
+        if self.stats.retries or self.stats.failures or self.stats.skipped:
+            print ("Price feed: {requests} requests, {retries} retries, "
+                   "{failures} failures, {skipped} skipped, "
+                   "{retry_time:.2f}s retrying".format(**self.stats.as_dict()))
+
+        return quotes
+
+    def load_ids(self):
+        """ Scrip to Google id mapping from earlier runs
+        """
+        try:
+            with open(SCRIP_ID_FILE) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_ids(self, scrip_ids):
+        dump_json_atomic(scrip_ids, SCRIP_ID_FILE, indent=2, sort_keys=True)
+
+    def fetch_ids(self, pool, url, scrips):
+        """ Get Google ids for a chunk of scrips
+        """
+        url = url + "/finance?output=json&q=" + ",".join(scrips)
+
+        response = json.loads(pool.get(url))
+        results = response["searchresults"]
+
+        # Results name their scrip, else trust the order
+        if all("e" in x and "t" in x for x in results):
+            return {normalize_scrip(x["e"] + ":" + x["t"]): x["id"] for x in results}
+
+        if len(results) != len(scrips):
+            raise KeyError("Search results do not match scrips")
+
+        return dict(zip(scrips, [x["id"] for x in results]))
+
+    def fetch_rows(self, pool, url, ids):
+        """ Get quote rows for a chunk of ids
+        """
+        columns = ["0", "1", "l", "c", "2", "cp", "3", "4", "e", "5", "t"]
+
+        url = (url + "/finance/data?" +
+               "output=json&catid=30,31&cid=" + ",".join(ids))
+
+        response = json.loads(pool.get(url))
+        response = response["company"]["related"]["rows"]
+
+        return [dict(zip(columns, x["values"])) for x in response]
+
+    def parse_row(self, item):
+        """ Scrip and quote from a quote row
+        """
+        scrip = normalize_scrip(item['e'] + ':' + item['t'])
+
+        quote = {
+            'price': item['l'].replace(',', ''),
+            'change': item['c'].replace(',', '') if item['c'] else "0",
+            'change_percentage': item['cp'].replace(',', '') if item['cp'] else "0"
+        }
+
+        return (scrip, quote)
+
+
+class SnapshotQuoteProvider(QuoteProvider):
+    """ Recorded quotes from a JSON or CSV file, for offline runs
+    """
+
+    def __init__(self, filename):
+        QuoteProvider.__init__(self)
+        self.quotes = load_quote_snapshot(filename)
+
+    def fetch_quotes(self, scrip_list):
+        return {scrip: dict(self.quotes[scrip]) for scrip in scrip_list if scrip in self.quotes}
+
+
+def load_quote_snapshot(filename):
+    """ Read recorded quotes - CSV with a scrip column, or JSON keyed by scrip
+    """
+    quotes = {}
+
+    if filename.lower().endswith(".csv"):
+        with open(filename) as f:
+            rows = [(row.pop("scrip"), row) for row in csv.DictReader(f)]
+    else:
+        with open(filename) as f:
+            rows = json.load(f).items()
+
+    for scrip, row in rows:
+        quotes[scrip] = {key: str(row.get(key) or "0") for key in QuoteCache.keys}
+
+    return quotes
+
+
+def save_quote_snapshot(quotes, filename):
+    """ Record quotes in a form SnapshotQuoteProvider can replay
+    """
+    if filename.lower().endswith(".csv"):
+        with open(filename, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(["scrip"] + QuoteCache.keys)
+
+            for scrip in sorted(quotes):
+                writer.writerow([scrip] + [quotes[scrip][key] for key in QuoteCache.keys])
+    else:
+        dump_json_atomic(quotes, filename, indent=2, sort_keys=True)
+
+
+class ScripManager:
+    """ Class for managing scrips
+    """
+
+    def __init__(self, refresh=False, provider=None, prices=None):
+        self.title = {}
+        self.scrip = {}
+        self.provider = provider or GoogleQuoteProvider()
+        self.cache = QuoteCache()
+        self.refresh = refresh
+
+        # PriceHistory the fetched quotes go to
+        self.prices = prices
+
+        self.load_titles()
+
+    def get_scrip_from_title(self, title):
+        if title not in self.title:
+            raise UnknownScripError("New Scrip! Add to scrip.json! [ {} ]".format(title))
+
+        return self.title[title]
+
+    def get_title_from_scrip(self, scrip):
+        return self.scrip[scrip]['title']
+
+    def get_price(self, scrip):
+        if 'price' not in self.scrip[scrip]:
+            self.load_prices([scrip])
+
+        scrip = self.scrip[scrip]
+
+        price = float(scrip['price'])
+        price_change = [
+            float(scrip['change']),
+            float(scrip['change_percentage'])
+        ]
+
+        return (price, price_change)
+
+    def has_price(self, scrip):
+        """ Whether scrip has a price, even a stale one
+        """
+        return not self.scrip[scrip].get('unpriced')
+
+    def get_quotes(self):
+        """ Prices loaded so far, as {scrip: {price, change, change_percentage}}
+        """
+        return {scrip: {key: value[key] for key in QuoteCache.keys}
+                for scrip, value in self.scrip.items()
+                if 'price' in value and not value.get('stale')}
+
+    def load_titles(self):
+        # List of titles
+        self.title = json.load(open("scrip.json"))
+
+        for k, v in self.title.items():
+            self.scrip.setdefault(v, {})['title'] = k
+
+    def load_prices(self, scrip_list):
+        """ Get prices for the scrips that do not have one yet, in one batch
+        """
+        missing = [scrip for scrip in scrip_list if 'price' not in self.scrip[scrip]]
+
+        if not self.refresh and self.provider.cacheable:
+            self.load_cached_prices(missing)
+            missing = [scrip for scrip in missing if 'price' not in self.scrip[scrip]]
+
+        if missing:
+            self.fetch_price(missing)
+
+    def refresh_prices(self):
+        """ Fetch every price loaded so far again
+        """
+        loaded = [scrip for scrip, value in self.scrip.items() if 'price' in value]
+
+        if loaded:
+            self.fetch_price(loaded)
+
+    def load_cached_prices(self, scrip_list):
+        """ Take the prices still fresh in the quote cache
+        """
+        now = time.time()
+
+        for scrip in scrip_list:
+            quote = self.cache.get(scrip, now)
+
+            if quote is not None:
+                self.scrip[scrip].update(quote)
+
+    @stage()
+    def fetch_price(self, scrip_list=None):
+        print "Retrieving market price..."
+
+        if scrip_list is None:
+            scrip_list = self.scrip.keys()
+
+        for scrip in scrip_list:
+            for key in QuoteCache.keys + ['stale', 'unpriced']:
+                self.scrip[scrip].pop(key, None)
+
+        quotes = self.provider.fetch(scrip_list)
+
+        now = time.time()
+
+        for scrip, quote in quotes.items():
+            self.scrip[scrip].update(quote)
+
+            if self.provider.cacheable:
+                self.cache.update(scrip, quote, now)
+
+        if self.provider.cacheable:
+            self.cache.save()
+
+            if self.prices is not None and quotes:
+                self.prices.record(quotes, now)
+
+        # Whatever we could not get is stale - fall back to the last known price
+        stale = [scrip for scrip in scrip_list if 'price' not in self.scrip[scrip]]
+
+        for scrip in stale:
+            last = self.cache.last(scrip) if self.provider.cacheable else None
+
+            self.scrip[scrip].update(last or {
+                'price': "0",
+                'change': "0",
+                'change_percentage': "0",
+                'unpriced': True
+            })
+            self.scrip[scrip]['stale'] = True
+
+        if stale:
+            print "Stale prices for: " + ", ".join(sorted(stale))
+
+
+@stage()
+def parse_cn_file(filename):
+    """ Get transaction data from Contract Note file
+    """
+    print "Processing file: " + filename + "..."
+    html = open(filename).read()
+
+    soup = BeautifulSoup(html, 'lxml')
+
+    trade_date = (soup.find('td',
+                            text=re.compile('TRADE DATE(.*)', re.DOTALL))
+                  .parent
+                  .findAll('td')[1]
+                  .text)
+
+    table = soup.find("td", class_="xl27boTBL").findParents("table")[0]
+
+    entries = []
+
+    # Just read all rows first
+    for row in table.findAll("tr"):
+        entry = []
+
+        for cell in row.findAll("td"):
+            entry.append("".join(c
+                                 for c in (str(unicode(cell.string)
+                                               .encode('ascii', 'ignore'))
+                                           .strip())
+                                 if c not in "*[]~"))
+
+        # Trade date as last column
+        entry.append(datetime.datetime.strftime(
+            datetime.datetime.strptime(trade_date, '%d/%m/%Y'),
+            '%Y-%m-%d'
+        ))
+
+        # Filter
+        if len(entry) > 11 and "".join(entry):
+            entries.append(entry)
+
+    # Delete unwanted entries
+    for entry in reversed(entries):
+        if "NET AMOUNT DUE" not in "".join(entry):
+            entries.pop()
+        else:
+            break
+
+    return entries
+
+
+def element_string(element):
+    """ Text of an lxml element the way BeautifulSoup's .string has it
+    """
+    while True:
+        children = list(element)
+        count = len(children) + sum(1 for child in children if child.tail)
+
+        if element.text:
+            if count:
+                return None
+
+            return element.text
+
+        if count != 1:
+            return None
+
+        element = children[0]
+
+        # Comments count as strings
+        if not isinstance(element.tag, basestring):
+            return element.text
+
+
+@stage()
+def parse_cn_file_fast(filename):
+    """ Get transaction data from Contract Note file - lxml version of
+    parse_cn_file, gives the same entries
+    """
+    print "Processing file: " + filename + "..."
+
+    root = lxml.html.parse(filename).getroot()
+
+    trade_date_re = re.compile('TRADE DATE(.*)', re.DOTALL)
+
+    for cell in root.iter('td'):
+        text = element_string(cell)
+
+        if text is not None and trade_date_re.search(text):
+            break
+    else:
+        raise ValueError("No TRADE DATE in {}".format(filename))
+
+    trade_date = cell.getparent().xpath('.//td')[1].text_content()
+
+    # Trade date as last column
+    trade_date = datetime.datetime.strftime(
+        datetime.datetime.strptime(trade_date, '%d/%m/%Y'),
+        '%Y-%m-%d'
+    )
+
+    anchor = root.xpath('(//td[contains(concat(" ", normalize-space(@class), " "),'
+                        ' " xl27boTBL ")])[1]')[0]
+    table = next(anchor.iterancestors('table'))
+
+    entries = []
+
+    for row in table.iter('tr'):
+        entry = [unicode(element_string(cell)).encode('ascii', 'ignore').strip().translate(None, "*[]~")
+                 for cell in row.iter('td')]
+
+        entry.append(trade_date)
+
+        # Filter
+        if len(entry) > 11:
+            entries.append(entry)
+
+    # Delete unwanted entries
+    for entry in reversed(entries):
+        if "NET AMOUNT DUE" not in "".join(entry):
+            entries.pop()
+        else:
+            break
+
+    return entries
+
+
+CN_PARSERS = {
+    "soup": parse_cn_file,
+    "lxml": parse_cn_file_fast
+}
+
+
+def parse_cn_worker(args):
+    """ Parse a Contract Note in a worker process - errors are returned, not raised
+    """
+    filename, parser = args
+
+    try:
+        return (filename, CN_PARSERS[parser](filename), None)
+    except Exception as e:
+        return (filename, None, "{}: {}".format(type(e).__name__, e))
+
+
+@stage()
+def import_cn_files(filenames, jobs=1, parser=None):
+    """ Transactions from Contract Note files, parsed by jobs processes
+
+    Results come in the order of filenames. A note that cannot be read is
+    reported and left out, so it is tried again next time. A security not
+    in scrip.json stops the import, as it did before.
+    """
+    imported = []
+    pool = None
+    start = time.time()
+    work = [(filename, parser or CN_PARSER) for filename in filenames]
+
+    if jobs > 1 and len(filenames) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(filenames)))
+        parsed = pool.imap(parse_cn_worker, work)
+    else:
+        parsed = itertools.imap(parse_cn_worker, work)
+
+    try:
+        for filename, entries, error in parsed:
+            if error is None:
+                try:
+                    imported.append((filename, crunch_cn_entries(process_cn_entries(entries))))
+                    continue
+                except UnknownScripError:
+                    raise
+                except Exception as e:
+                    error = "{}: {}".format(type(e).__name__, e)
+
+            print "Skipping file: " + filename + " [ " + error + " ]"
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if filenames:
+        elapsed = max(time.time() - start, 1e-6)
+
+        print "Imported {} of {} contract notes in {:.2f}s ({:.1f} files/s)".format(
+            len(imported), len(filenames), elapsed, len(filenames) / elapsed)
+
+    return imported
+
+
+class Keywords:
+    """ Test for text containing any of keywords, with one compiled regex -
+    the same as any(k in text for k in keywords). Memoised for the few
+    distinct texts that keys are.
+    """
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self.pattern = re.compile("|".join(re.escape(k) for k in self.keywords) or "(?!)")
+        self.memo = {}
+
+    def search(self, text):
+        return self.pattern.search(text) is not None
+
+    def key(self, key):
+        try:
+            return self.memo[key]
+        except KeyError:
+            self.memo[key] = self.search(key)
+            return self.memo[key]
+
+
+# Contract Note rows and keys to leave out, old and new (True) format
+CN_SCRAP_ROWS = Keywords(['ISIN', 'BUY AVERAGE', 'SELL AVERAGE', 'NET AVERAGE', 'Delivery Total'])
+CN_SCRAP_KEYS = {
+    False: Keywords(COLUMNS[:3]),
+    True: Keywords(COLUMNS[:3] + ['Buy/Sell', 'Remarks'])
+}
+CN_SCRAP_SCRIP_KEYS = {
+    False: Keywords(COLUMNS[:3] + ['STT SELL DELIVERY', 'STT BUY DELIVERY']),
+    True: Keywords(COLUMNS[:3] + ['STT SELL DELIVERY', 'STT BUY DELIVERY', 'Buy/Sell', 'Remarks'])
+}
+CN_SCRAP_MISC_KEYS = Keywords(['NET AMOUNT DUE TO', 'DR. TOTAL', 'CR. TOTAL'])
+
+
+def process_cn_entry(entry, is_new_html_format=False):
+    """ Process a single entry from CN
+    """
+    processed_entry = {}
+
+    if is_new_html_format:
+        processed_entry.update(dict(zip(COLUMNS_NEW, entry)))
+    else:
+        processed_entry.update(dict(zip(COLUMNS, entry)))
+
+    if is_new_html_format:
+        processed_entry['Type'] = ("SELL"
+                                   if processed_entry['Buy/Sell'] == 'S'
+                                   else "BUY")
+    else:
+        if 'Sold Qty' in processed_entry and processed_entry['Sold Qty']:
+            processed_entry['Type'] = "SELL"
+            processed_entry['Quantity'] = processed_entry.pop("Sold Qty")
+        elif 'Bought Qty' in processed_entry and processed_entry['Bought Qty']:
+            processed_entry['Type'] = "BUY"
+            processed_entry['Quantity'] = processed_entry.pop("Bought Qty")
+
+    # Total is always positive value
+    if(float(processed_entry['Total']) < 0):
+        processed_entry['Total'] = str(abs(float(processed_entry['Total'])))
+
+    # Is this intraday?
+    brokerage_rate = float(processed_entry['Brokerage']) / float(processed_entry['Gross Rate'])
+
+    if brokerage_rate < BROKERAGE_RATE_DELIVERY:
+        processed_entry['Intraday'] = True
+    else:
+        processed_entry['Intraday'] = False
+
+    processed_entry['Scrip'] = scrip_manager.get_scrip_from_title(processed_entry['Security'])
+
+    scrap_keys = CN_SCRAP_KEYS[is_new_html_format]
+
+    # Scrap
+    processed_entry = {key:value for key,value in processed_entry.items() if not scrap_keys.key(key) and (key == 'Intraday' or value)}
+
+    return processed_entry
+
+
+def process_cn_entries(entries):
+    """ Process transactions from Contract Notes
+    """
+    is_data = False
+    is_scrip = False
+    is_misc = False
+    is_new_html_format = False
+    item = {}
+    items = []
+    misc = {}
+
+    # Prune empty entries - joining each once
+    rows = [(entry, "".join(entry)) for entry in entries]
+    rows = [(entry, text) for entry, text in rows if text.strip()]
+
+    # New format?
+    if len(rows[0][0]) == 14:
+        is_new_html_format = True
+
+    for entry, text in rows:
+        # Scrap unnecessary entries
+        if CN_SCRAP_ROWS.search(text):
+            continue
+
+        # Clean
+        entry = [x.strip() for x in entry]
+
+        if entry[0] and entry[0].isdigit():
+            is_data = True
+
+        if is_data:
+            # Scrip entries start
+            if not is_scrip:
+                is_scrip = True
+
+                item = process_cn_entry(entry, is_new_html_format)
+            else:
+                # More entries for same scrip
+                if entry[0] and entry[0].isdigit():
+                    next_item = process_cn_entry(entry, is_new_html_format)
+
+                    # Move the first entry as first entry in Trades
+                    if "Trades" not in item:
+                        item = {"Trades": [item]}
+
+                    item["Trades"].append(next_item)
+
+                    # Let's continue on to next entry
+                    continue
+
+                col = 11 if is_new_html_format else 12
+
+                if entry[col]:
+                    item[entry[4].strip("*").strip()] = entry[col]
+
+                # Entries for the scrip are done
+                if "TOTAL STT" in entry[4] or not entry[col]:
+                    is_scrip = False
+                    is_data = False
+
+                    # Cleanup
+                    scrap_keys = CN_SCRAP_SCRIP_KEYS[is_new_html_format]
+
+                    item = {key: value for key, value in item.items() if not scrap_keys.key(key) and value}
+
+                    if "TOTAL STT" in item:
+                        item['STT'] = item.pop("TOTAL STT")
+
+                    items.append(item)
+
+                    if not entry[col]:
+                        is_misc = True
+        else:
+            if items:
+                is_misc = True
+
+        # Process MISC entries
+        if is_misc:
+            col = 11 if is_new_html_format else 13
+            if not entry[col - 1] or is_new_html_format:
+                misc[entry[4].strip("*").strip("[]").strip("~").strip()] = entry[col]
+
+        # Maybe there is entries from next Exchange after this?
+        if is_misc and "NET AMOUNT DUE" in "".join(entry):
+            is_misc = False
+
+    # Misc Charges
+    misc = {key: value for key, value in misc.items() if not CN_SCRAP_MISC_KEYS.key(key)}
+    misc['Total'] = sum(float(item) for key, item in misc.items())
+    misc['Type'] = MISC_KEY
+    items.append(misc)
+
+    return items
+
+
+def crunch_cn_entries(entries):
+    """ Crunch entries
+    """
+    crunched_entries = []
+
+    for entry in entries:
+        # Expand multiple trade entries
+        if "Trades" in entry:
+            crunched_entries.extend(entry["Trades"])
+        else:
+            if entry["Type"] == "MISC":
+                misc_entry = {key: value for key, value in entry.items() if key in ["Type", "Total"]}
+                crunched_entries.append(misc_entry)
+            else:
+                crunched_entries.append(entry)
+
+    return crunched_entries
+
+
+def read_number(value, readings=None):
+    """ A number from an entry, and how it was written: the decimal places
+    of a string, 'f' for a float or 'i' for an integer. The form is None if
+    it could not be written back the same way.
+
+    readings has the strings read so far, for numbers that repeat a lot.
+    """
+    if isinstance(value, basestring):
+        if readings is not None and value in readings:
+            return readings[value]
+
+        try:
+            number = float(value)
+        except ValueError:
+            return (None, None)
+
+        places = len(value) - value.find('.') - 1 if '.' in value else 0
+        reading = (number, places if '%.*f' % (places, number) == value else None)
+
+        if readings is not None:
+            readings[value] = reading
+
+        return reading
+
+    if type(value) is float:
+        return (value, 'f')
+
+    if type(value) in (int, long) and float(value) == value:
+        return (float(value), 'i')
+
+    try:
+        return (float(value), None)
+    except (TypeError, ValueError):
+        return (None, None)
+
+
+def read_stamp(value, pattern, stamps):
+    """ A trade date or time as its digits, if it is written like pattern
+
+    stamps has the ones read so far - there are few different ones.
+    """
+    if not isinstance(value, basestring):
+        return (value, 'v') if value is not None else (None, None)
+
+    if value not in stamps:
+        if pattern.match(value):
+            # Sorts the same as the text
+            stamps[value] = (int(value[:-6] + value[-5:-3] + value[-2:]), 'd')
+        else:
+            stamps[value] = (value, 'v')
+
+    return stamps[value]
+
+
+def write_number(number, form):
+    """ A number written the way read_number found it
+    """
+    if form == 'f':
+        return number
+
+    if form == 'i':
+        return int(number)
+
+    return '%.*f' % (form, number)
+
+
+def write_stamp(stamp, form, layout):
+    """ A trade date or time written the way read_stamp found it
+    """
+    if form == 'v':
+        return stamp
+
+    return layout % (stamp // 10000, stamp // 100 % 100, stamp % 100)
+
+
+class Transaction(object):
+    """ A trade (or misc charges) with its numbers parsed once
+
+    Quantity, Total and Brokerage are floats, and the trade date and time
+    are integers like 20160123 and 91500. forms has how each of those was
+    written, so to_dict gives back the entry as it was read. Fields without
+    an attribute are a tuple of values against a shared tuple of keys.
+    """
+    __slots__ = ['scrip', 'type', 'quantity', 'total', 'brokerage', 'date', 'time', 'intraday',
+                 'forms', 'keys', 'values']
+
+    DATE = re.compile(r'\d{4}-\d\d-\d\d\Z')
+    TIME = re.compile(r'\d\d:\d\d:\d\d\Z')
+
+    # Scrips, securities, key tuples and form tuples, one copy of each
+    shared = {}
+
+    # Readings of repeating dates, times, quantities and brokerages
+    dates = {}
+    times = {}
+    readings = {}
+
+    # Sorted keys for the order a dict has them in
+    layouts = {}
+
+    @classmethod
+    def share(cls, value):
+        return cls.shared.setdefault(value, value)
+
+    @classmethod
+    def forget(cls):
+        """ Empty the shared values and readings, which only grow - for
+        each import of a long running process
+        """
+        for table in (cls.shared, cls.dates, cls.times, cls.readings, cls.layouts):
+            table.clear()
+
+    @classmethod
+    def from_dict(cls, entry):
+        """ Transaction from an entry of __trades.json (or one being imported)
+        """
+        share = cls.shared.setdefault
+        self = cls.__new__(cls)
+
+        extra = dict(entry)
+        pop = extra.pop
+
+        scrip = pop('Scrip', None)
+        kind = pop('Type', None)
+        self.scrip = share(scrip, scrip)
+        self.type = share(kind, kind)
+        self.intraday = pop('Intraday', None)
+
+        self.quantity, quantity_form = read_number(pop('Quantity', None), cls.readings)
+        self.total, total_form = read_number(pop('Total', None))
+        self.brokerage, brokerage_form = read_number(pop('Brokerage', None), cls.readings)
+        self.date, date_form = read_stamp(pop('Trade Date', None), cls.DATE, cls.dates)
+        self.time, time_form = read_stamp(pop('Trade Time', None), cls.TIME, cls.times)
+
+        forms = (quantity_form, total_form, brokerage_form, date_form, time_form)
+
+        # Nulls, and numbers that would be written differently, stay as they are
+        if None in forms or None in (scrip, kind, self.intraday):
+            for key, form in zip(['Quantity', 'Total', 'Brokerage', 'Trade Date', 'Trade Time',
+                                  'Scrip', 'Type', 'Intraday'], forms + (0, 0, 0)):
+                if key in entry and (form is None or entry[key] is None):
+                    extra[key] = entry[key]
+
+        if 'Security' in extra:
+            extra['Security'] = share(extra['Security'], extra['Security'])
+
+        layout = tuple(extra)
+
+        if layout not in cls.layouts:
+            cls.layouts[layout] = share(tuple(sorted(layout)), tuple(sorted(layout)))
+
+        keys = cls.layouts[layout]
+
+        self.forms = share(forms, forms)
+        self.keys = keys
+        self.values = tuple(map(extra.__getitem__, keys))
+
+        return self
+
+    def to_dict(self):
+        """ The entry as it was read
+        """
+        entry = dict(zip(self.keys, self.values))
+        quantity_form, total_form, brokerage_form, date_form, time_form = self.forms
+
+        if self.scrip is not None:
+            entry['Scrip'] = self.scrip
+
+        if self.type is not None:
+            entry['Type'] = self.type
+
+        if self.intraday is not None:
+            entry['Intraday'] = self.intraday
+
+        if quantity_form is not None:
+            entry['Quantity'] = write_number(self.quantity, quantity_form)
+
+        if total_form is not None:
+            entry['Total'] = write_number(self.total, total_form)
+
+        if brokerage_form is not None:
+            entry['Brokerage'] = write_number(self.brokerage, brokerage_form)
+
+        if date_form is not None:
+            entry['Trade Date'] = write_stamp(self.date, date_form, '%04d-%02d-%02d')
+
+        if time_form is not None:
+            entry['Trade Time'] = write_stamp(self.time, time_form, '%02d:%02d:%02d')
+
+        return entry
+
+    def extra(self, key, default=None):
+        """ A field without an attribute
+        """
+        if key in self.keys:
+            return self.values[self.keys.index(key)]
+
+        return default
+
+    def drop(self, key):
+        """ Remove a field without an attribute
+        """
+        if key in self.keys:
+            i = self.keys.index(key)
+            self.keys = self.share(self.keys[:i] + self.keys[i + 1:])
+            self.values = self.values[:i] + self.values[i + 1:]
+
+
+def transaction_key(entry):
+    """ Order of transactions - by scrip, then time
+    """
+    return (entry.scrip, entry.date, entry.time)
+
+
+class TradeHistory:
+    """ What TradeStore and TradeDatabase have in common
+    """
+
+    def misc_entry(self):
+        return Transaction.from_dict({"Type": MISC_KEY, "Total": self.misc_total})
+
+    def export(self):
+        """ The trade history as __trades.json has it
+        """
+        return [entry.to_dict() for entry in self.transactions()] + [self.misc_entry().to_dict()]
+
+    def import_json(self, entries):
+        """ Start the history from __trades.json entries
+        """
+        transactions = map(Transaction.from_dict, entries)
+        misc_total = 0
+
+        for entry in transactions:
+            if entry.type == MISC_KEY:
+                misc_total += entry.to_dict()["Total"]
+
+        self.append(sorted([entry for entry in transactions if entry.type != MISC_KEY],
+                           key=transaction_key), misc_total)
+
+
+class TradeStore(TradeHistory):
+    """ Append-only trade history
+
+    Each transaction is a fixed-width RECORD in the .bin file, read through
+    mmap. Fields without an attribute, and anything kept verbatim, are a
+    line of JSON in the .extra file. The .idx file has the record numbers
+    in transaction_key order, ties in the order they came - each append
+    writes a new one, .idx.1, .idx.2 and so on. The .meta.json file has
+    the scrip and type tables, which index file is current, where each
+    scrip is in it, the IPO records and the misc charges.
+
+    Appends are not part of the history until commit() writes the meta
+    file. Records past what it has are dropped when the store is opened.
+    """
+    # scrip, type, intraday, flags, forms x 5, quantity, total, brokerage,
+    # date, time, extra offset, extra length
+    RECORD = struct.Struct('<IBBB5bdddIIQI')
+    FORMS = slice(4, 9)
+
+    # Flags
+    IPO = 1
+    INTRADAY = 2
+    VERBATIM = 4
+
+    # Number forms other than decimal places
+    NUMBER_FORMS = {'f': -1, 'i': -2, None: -3}
+
+    # Stamp forms, and the stamp of one that is not like 2016-01-23 / 09:15:00
+    STAMP_FORMS = {None: 0, 'd': 1, 'v': 2}
+    VERBATIM_STAMP = 0xffffffff
+
+    def __init__(self, path=TRADE_STORE):
+        self.record_file = path + ".bin"
+        self.index_base = path + ".idx"
+        self.extra_file = path + ".extra"
+        self.meta_file = path + ".meta.json"
+
+        try:
+            with open(self.meta_file) as f:
+                self.meta = json.load(f)
+        except IOError:
+            self.meta = {
+                "count": 0,
+                "extra_size": 0,
+                "scrips": [],
+                "types": [],
+                "ranges": [],
+                "ipo": [],
+                "misc_total": 0
+            }
+
+        self.index_file = self.index_name(self.meta.get("index", 0))
+        self.index = array('I')
+
+        # Index files the next commit leaves behind
+        self.replaced = []
+
+        if self.meta["count"]:
+            with open(self.index_file, 'rb') as f:
+                self.index.fromstring(f.read())
+
+        self.scrip_codes = {scrip: i for i, scrip in enumerate(self.meta["scrips"])}
+        self.type_codes = {kind: i for i, kind in enumerate(self.meta["types"])}
+        self.forms = {}
+
+        self.map_files()
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    @property
+    def misc_total(self):
+        return self.meta["misc_total"]
+
+    def index_name(self, version):
+        return self.index_base if not version else "{}.{}".format(self.index_base, version)
+
+    def close(self):
+        for mapped in (self.records, self.extras):
+            if mapped is not None:
+                mapped.close()
+
+    def map_files(self):
+        """ Map what the meta file has, dropping anything appended after it
+        """
+        self.records = None
+        self.extras = None
+
+        for filename, size, name in [(self.record_file, self.count * self.RECORD.size, "records"),
+                                     (self.extra_file, self.meta["extra_size"], "extras")]:
+            if not os.path.exists(filename):
+                open(filename, 'wb').close()
+
+            # The first append writes the meta file before any record
+            if os.path.getsize(filename) and not os.path.exists(self.meta_file):
+                raise Exception("{} has trades but {} is missing - restore it, or move the "
+                                "store away to start again".format(filename, self.meta_file))
+
+            if os.path.getsize(filename) > size:
+                with open(filename, 'r+b') as f:
+                    f.truncate(size)
+
+            if size:
+                with open(filename, 'rb') as f:
+                    setattr(self, name, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ))
+
+    def ranges(self):
+        return {scrip: (start, end) for scrip, start, end in self.meta["ranges"]}
+
+    def pack(self, entry, offset):
+        """ RECORD and extras line of a transaction
+        """
+        extra = dict(zip(entry.keys, entry.values))
+        flags = 0
+
+        if entry.extra('Notes') == "IPO":
+            flags |= self.IPO
+
+        if entry.intraday:
+            flags |= self.INTRADAY
+
+        if entry.intraday is None:
+            intraday = 2
+        elif type(entry.intraday) is bool:
+            intraday = int(entry.intraday)
+        else:
+            intraday = 3
+            extra['Intraday'] = entry.intraday
+
+        forms = []
+        numbers = []
+
+        for key, form, number in zip(['Quantity', 'Total', 'Brokerage'], entry.forms,
+                                     [entry.quantity, entry.total, entry.brokerage]):
+            if form not in self.NUMBER_FORMS and form > 100:
+                # Too many places for the record - keep the text
+                extra[key] = write_number(number, form)
+                form = None
+
+            forms.append(self.NUMBER_FORMS.get(form, form))
+            numbers.append(float('nan') if number is None else number)
+
+        stamps = []
+
+        for key, form, stamp in zip(['Trade Date', 'Trade Time'], entry.forms[3:],
+                                    [entry.date, entry.time]):
+            if form == 'v':
+                extra[key] = stamp
+                stamp = self.VERBATIM_STAMP
+            elif form is None:
+                stamp = 0
+
+            forms.append(self.STAMP_FORMS[form])
+            stamps.append(stamp)
+
+        if intraday == 3 or -3 in forms[:3] or 2 in forms[3:]:
+            flags |= self.VERBATIM
+
+        line = json.dumps(extra, sort_keys=True) if extra else ""
+
+        record = self.RECORD.pack(self.code("scrips", self.scrip_codes, entry.scrip),
+                                  self.code("types", self.type_codes, entry.type),
+                                  intraday, flags, *(forms + numbers + stamps + [offset, len(line)]))
+
+        return (record, line)
+
+    def code(self, table, codes, value):
+        if value not in codes:
+            codes[value] = len(self.meta[table])
+            self.meta[table].append(value)
+
+        return codes[value]
+
+    def transaction(self, number, extras=True):
+        """ Transaction of a record - without the fields that have no
+        attribute, if extras is False. That is enough to crunch.
+        """
+        fields = self.RECORD.unpack_from(self.records, number * self.RECORD.size)
+        (scrip, kind, intraday, flags) = fields[:4]
+        (quantity, total, brokerage, date, stamp_time, offset, length) = fields[9:]
+
+        entry = Transaction.__new__(Transaction)
+        entry.scrip = self.meta["scrips"][scrip]
+        entry.type = self.meta["types"][kind]
+
+        # Nothing verbatim and nothing else to read
+        if not flags & self.VERBATIM and not (length and extras):
+            forms = self.forms.get(fields[self.FORMS]) or self.read_forms(fields[self.FORMS])
+
+            entry.intraday = (False, True, None)[intraday]
+            entry.quantity = quantity
+            entry.total = total
+            entry.brokerage = brokerage
+            entry.date = date if forms[3] else None
+            entry.time = stamp_time if forms[4] else None
+            entry.forms = forms
+            entry.keys = ()
+            entry.values = ()
+
+            return entry
+
+        forms = list(fields[self.FORMS])
+
+        if length:
+            extra = json.loads(self.extras[offset:offset + length])
+        else:
+            extra = {}
+
+        entry.intraday = (False, True, None)[intraday] if intraday < 3 else extra.pop('Intraday')
+
+        numbers = []
+
+        for i, (key, number) in enumerate(zip(['Quantity', 'Total', 'Brokerage'],
+                                              [quantity, total, brokerage])):
+            if forms[i] == -3:
+                forms[i] = None
+                number = read_number(extra.get(key))[0]
+            elif forms[i] < 0:
+                forms[i] = 'f' if forms[i] == -1 else 'i'
+
+            numbers.append(number)
+
+        (entry.quantity, entry.total, entry.brokerage) = numbers
+
+        stamps = []
+
+        for i, (key, stamp) in enumerate(zip(['Trade Date', 'Trade Time'], [date, stamp_time]), 3):
+            forms[i] = (None, 'd', 'v')[forms[i]]
+
+            if forms[i] == 'v':
+                stamp = extra.pop(key)
+            elif forms[i] is None:
+                stamp = None
+
+            stamps.append(stamp)
+
+        (entry.date, entry.time) = stamps
+
+        if 'Security' in extra:
+            extra['Security'] = Transaction.share(extra['Security'])
+
+        entry.forms = Transaction.share(tuple(forms))
+        entry.keys = Transaction.share(tuple(sorted(extra)))
+        entry.values = tuple(extra[k] for k in entry.keys)
+
+        return entry
+
+    def read_forms(self, codes):
+        """ Transaction forms of the form codes of a record without verbatim fields
+        """
+        forms = [{-1: 'f', -2: 'i'}.get(code, code) for code in codes[:3]]
+        forms += [(None, 'd')[code] for code in codes[3:]]
+
+        self.forms[codes] = Transaction.share(tuple(forms))
+
+        return self.forms[codes]
+
+    def positions(self, scrips=None):
+        """ Index positions of the records of scrips (default all), in order
+        """
+        if scrips is None:
+            return self.index
+
+        ranges = self.ranges()
+        positions = array('I')
+
+        for scrip in sorted(set(scrips) & set(ranges)):
+            start, end = ranges[scrip]
+            positions.extend(self.index[start:end])
+
+        return positions
+
+    def transactions(self, scrips=None, extras=True):
+        """ Transactions of scrips (default all), in transaction_key order
+        """
+        return [self.transaction(number, extras) for number in self.positions(scrips)]
+
+    def stamp(self, number):
+        return self.RECORD.unpack_from(self.records, number * self.RECORD.size)[12:14]
+
+    def last_stamps(self):
+        """ Trade date and time of the last trade of each scrip
+        """
+        return {scrip: transaction_key(self.transaction(self.index[end - 1], False))[1:]
+                for scrip, start, end in self.meta["ranges"]}
+
+    def ipo_investment(self):
+        """ Total of the IPO trades, added in transaction_key order
+        """
+        entries = sorted((transaction_key(self.transaction(number, False)), number)
+                         for number in self.meta["ipo"])
+
+        return sum(self.transaction(number, False).total for key, number in entries)
+
+    def columns(self):
+        """ Scrips and typed columns of all the records in transaction_key
+        order, as trade_columns has them - without reading the records
+        """
+        dtype = numpy.dtype([('scrip', '<u4'), ('type', 'u1'), ('intraday', 'u1'), ('flags', 'u1'),
+                             ('forms', 'i1', 5), ('quantity', '<f8'), ('total', '<f8'),
+                             ('brokerage', '<f8'), ('date', '<u4'), ('time', '<u4'),
+                             ('offset', '<u8'), ('length', '<u4')])
+
+        if not self.count:
+            return ([], None)
+
+        records = numpy.frombuffer(self.records, dtype, self.count)
+        records = records[numpy.frombuffer(self.index, numpy.uint32)]
+
+        columns = {
+            "code": records['scrip'].astype(numpy.intp),
+            "quantity": records['quantity'],
+            "total": records['total'],
+            "brokerage": records['brokerage'],
+            "buy": records['type'] == self.type_codes.get('BUY', -1),
+            "intraday": (records['flags'] & self.INTRADAY) != 0,
+            "date": numpy.where(records['date'] == self.VERBATIM_STAMP, 0, records['date']).astype(numpy.int64)
+        }
+
+        return (list(self.meta["scrips"]), columns)
+
+    @stage("TradeStore.append")
+    def append(self, entries, misc_total):
+        """ Add transactions, and set the misc charges total - until commit()
+        """
+        if not entries:
+            self.meta["misc_total"] = misc_total
+            return
+
+        if not os.path.exists(self.meta_file):
+            dump_json_atomic(self.meta, self.meta_file)
+
+        added = {}
+        offset = self.meta["extra_size"]
+        number = self.count
+
+        with open(self.record_file, 'ab') as records, open(self.extra_file, 'ab') as extras:
+            for entry in entries:
+                record, line = self.pack(entry, offset)
+
+                records.write(record)
+
+                if line:
+                    extras.write(line + "\n")
+                    offset += len(line) + 1
+
+                if entry.extra('Notes') == "IPO":
+                    self.meta["ipo"].append(number)
+
+                stamp = self.RECORD.unpack(record)[12:14]
+                added.setdefault(entry.scrip, []).append((stamp, number))
+                number += 1
+
+            for f in (records, extras):
+                f.flush()
+                os.fsync(f.fileno())
+
+        # Merge the new records into the index, scrip by scrip
+        old_ranges = self.ranges()
+        index = array('I')
+        ranges = []
+
+        for scrip in sorted(set(old_ranges) | set(added)):
+            start, end = old_ranges.get(scrip, (0, 0))
+            merged = self.merge(self.index[start:end], sorted(added.get(scrip, [])))
+
+            ranges.append([scrip, len(index), len(index) + len(merged)])
+            index.extend(merged)
+
+        # Next to the committed index, not over it
+        version = self.meta.get("index", 0) + 1
+        write_atomic(self.index_name(version), index.tofile)
+
+        self.replaced.append(self.index_file)
+        self.index_file = self.index_name(version)
+        self.index = index
+        self.meta.update(count=number, extra_size=offset, ranges=ranges, misc_total=misc_total, index=version)
+
+        self.map_files()
+
+    @stage("TradeStore.commit")
+    def commit(self):
+        """ Write the meta file, which makes the appends so far part of the
+        history
+        """
+        dump_json_atomic(self.meta, self.meta_file)
+
+        for filename in self.replaced:
+            if filename != self.index_file and os.path.exists(filename):
+                os.remove(filename)
+
+        self.replaced = []
+
+    def merge(self, old, added):
+        """ Index positions old with the new (stamp, record number) added.
+        A new record goes after the old ones with the same stamp.
+        """
+        merged = array('I')
+        copied = 0
+
+        for stamp, number in added:
+            start = copied
+            end = len(old)
+
+            while start < end:
+                middle = (start + end) // 2
+
+                if self.stamp(old[middle]) <= stamp:
+                    start = middle + 1
+                else:
+                    end = middle
+
+            merged.extend(old[copied:start])
+            merged.append(number)
+            copied = start
+
+        merged.extend(old[copied:])
+
+        return merged
+
+
+class TradeDatabase(TradeHistory):
+    """ Trade history, dividends and processed input files in SQLite
+
+    A transaction is a row, with the fields TradeStore has in its RECORD and
+    the rest as JSON. The transactions_key index has them in transaction_key
+    order - SQLite sorts NULL, then numbers, then text, like Python 2 does -
+    so a scrip's trades are read without reading anyone else's.
+
+    Writes are not committed until commit(), so a run lands whole or not at
+    all.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY,
+            scrip,
+            type,
+            intraday INTEGER,
+            flags INTEGER,
+            forms TEXT,
+            quantity REAL,
+            total REAL,
+            brokerage REAL,
+            date,
+            time,
+            extra TEXT
+        );
+        CREATE INDEX IF NOT EXISTS transactions_key ON transactions (scrip, date, time, id);
+        CREATE INDEX IF NOT EXISTS transactions_ipo ON transactions (scrip, date, time, id)
+            WHERE flags & 1;
+        CREATE TABLE IF NOT EXISTS dividends (
+            id INTEGER PRIMARY KEY,
+            scrip,
+            entry TEXT
+        );
+        CREATE TABLE IF NOT EXISTS dividend_totals (
+            scrip,
+            total REAL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS dividend_totals_scrip ON dividend_totals (scrip);
+        CREATE TABLE IF NOT EXISTS processed (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT);
+    """
+
+    FIELDS = "scrip, type, intraday, flags, forms, quantity, total, brokerage, date, time, extra"
+    ORDER = "ORDER BY scrip, date, time, id"
+
+    # Most scrips to ask for in one query
+    CHUNK_SIZE = 500
+
+    def __init__(self, filename=TRADE_DATABASE):
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(self.SCHEMA)
+        self.state = SqliteMapping(self.db, "state")
+        self.dividends = DividendTable(self.db)
+        self.forms = {}
+
+    @property
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+    @property
+    def misc_total(self):
+        return self.state.get("misc_total", 0)
+
+    def processed_index(self, data=None):
+        """ ProcessedIndex over the processed and hashes tables
+        """
+        return ProcessedIndex(data, SqliteMapping(self.db, "processed"), SqliteMapping(self.db, "hashes"))
+
+    @stage("TradeDatabase.commit")
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        """ Close the database, dropping what was not committed
+        """
+        self.db.close()
+
+    def row(self, entry):
+        """ transactions row of a transaction
+        """
+        extra = dict(zip(entry.keys, entry.values))
+        flags = 0
+
+        if entry.extra('Notes') == "IPO":
+            flags |= TradeStore.IPO
+
+        if entry.intraday:
+            flags |= TradeStore.INTRADAY
+
+        if entry.intraday is None:
+            intraday = 2
+        elif type(entry.intraday) is bool:
+            intraday = int(entry.intraday)
+        else:
+            intraday = 3
+            extra['Intraday'] = entry.intraday
+
+        forms = list(entry.forms)
+        numbers = [entry.quantity, entry.total, entry.brokerage]
+
+        for i, key in enumerate(['Quantity', 'Total', 'Brokerage']):
+            if numbers[i] != numbers[i]:
+                # SQLite has NaN as NULL - keep the text
+                if forms[i] is not None:
+                    extra[key] = write_number(numbers[i], forms[i])
+                    forms[i] = None
+
+                numbers[i] = None
+
+        stamps = [entry.date, entry.time]
+
+        for i, key in enumerate(['Trade Date', 'Trade Time']):
+            if forms[i + 3] == 'v':
+                extra[key] = stamps[i]
+
+                # Sorted by value, if SQLite can have it as one
+                if not isinstance(stamps[i], (basestring, int, long, float)):
+                    stamps[i] = None
+
+        if intraday == 3 or None in forms[:3] or 'v' in forms[3:]:
+            flags |= TradeStore.VERBATIM
+
+        return [entry.scrip, entry.type, intraday, flags, json.dumps(forms)] + numbers + stamps + \
+            [json.dumps(extra, sort_keys=True) if extra else None]
+
+    def transaction(self, row, extras=True):
+        """ Transaction of a row - without the fields that have no attribute,
+        if extras is False
+        """
+        (scrip, kind, intraday, flags, forms, quantity, total, brokerage, date, stamp_time, extra) = row
+
+        entry = Transaction.__new__(Transaction)
+        entry.scrip = Transaction.share(scrip)
+        entry.type = Transaction.share(kind)
+
+        if not flags & TradeStore.VERBATIM and not (extra and extras):
+            entry.intraday = (False, True, None)[intraday]
+            entry.quantity = quantity
+            entry.total = total
+            entry.brokerage = brokerage
+            entry.date = date
+            entry.time = stamp_time
+            entry.forms = self.forms.get(forms) or self.read_forms(forms)
+            entry.keys = ()
+            entry.values = ()
+
+            return entry
+
+        forms = json.loads(forms)
+        extra = json.loads(extra) if extra else {}
+
+        entry.intraday = (False, True, None)[intraday] if intraday < 3 else extra.pop('Intraday')
+
+        numbers = [quantity, total, brokerage]
+
+        for i, key in enumerate(['Quantity', 'Total', 'Brokerage']):
+            if forms[i] is None:
+                numbers[i] = read_number(extra.get(key))[0]
+
+        (entry.quantity, entry.total, entry.brokerage) = numbers
+
+        stamps = [date, stamp_time]
+
+        for i, key in enumerate(['Trade Date', 'Trade Time']):
+            if forms[i + 3] == 'v':
+                stamps[i] = extra.pop(key)
+
+        (entry.date, entry.time) = stamps
+
+        if 'Security' in extra:
+            extra['Security'] = Transaction.share(extra['Security'])
+
+        entry.forms = Transaction.share(tuple(forms))
+        entry.keys = Transaction.share(tuple(sorted(extra)))
+        entry.values = tuple(extra[k] for k in entry.keys)
+
+        return entry
+
+    def read_forms(self, text):
+        self.forms[text] = Transaction.share(tuple(json.loads(text)))
+
+        return self.forms[text]
+
+    def transactions(self, scrips=None, extras=True):
+        """ Transactions of scrips (default all), in transaction_key order
+        """
+        query = "SELECT {} FROM transactions {{}} {}".format(self.FIELDS, self.ORDER)
+
+        if scrips is None:
+            return [self.transaction(row, extras) for row in self.db.execute(query.format(""))]
+
+        entries = []
+
+        for chunk in chunk_list(sorted(set(scrips)), self.CHUNK_SIZE):
+            rows = self.db.execute(query.format("WHERE scrip IN ({})".format(",".join("?" * len(chunk)))),
+                                   chunk)
+            entries.extend(self.transaction(row, extras) for row in rows)
+
+        return entries
+
+    def last_stamps(self):
+        """ Trade date and time of the last trade of each scrip
+        """
+        query = "SELECT {} FROM transactions WHERE scrip IS ? " \
+                "ORDER BY date DESC, time DESC, id DESC LIMIT 1".format(self.FIELDS)
+        stamps = {}
+
+        for (scrip,) in self.db.execute("SELECT DISTINCT scrip FROM transactions").fetchall():
+            row = self.db.execute(query, (scrip,)).fetchone()
+            stamps[scrip] = transaction_key(self.transaction(row, False))[1:]
+
+        return stamps
+
+    def ipo_investment(self):
+        """ Total of the IPO trades, added in transaction_key order
+        """
+        rows = self.db.execute("SELECT {} FROM transactions WHERE flags & 1 {}".format(self.FIELDS, self.ORDER))
+
+        return sum(self.transaction(row, False).total for row in rows)
+
+    def columns(self):
+        """ Scrips and typed columns of all the transactions in
+        transaction_key order, as trade_columns has them
+        """
+        rows = self.db.execute("SELECT scrip, type = 'BUY', flags & {}, quantity, total, brokerage, "
+                               "CASE WHEN typeof(date) = 'integer' THEN date ELSE 0 END "
+                               "FROM transactions {}".format(TradeStore.INTRADAY, self.ORDER)).fetchall()
+
+        if not rows:
+            return ([], None)
+
+        (scrips, buy, intraday, quantity, total, brokerage, date) = zip(*rows)
+        del(rows)
+
+        codes = {}
+        code = [codes.setdefault(scrip, len(codes)) for scrip in scrips]
+
+        columns = {
+            "code": numpy.array(code, dtype=numpy.intp),
+            "quantity": numpy.array(quantity, dtype=float),
+            "total": numpy.array(total, dtype=float),
+            "brokerage": numpy.array(brokerage, dtype=float),
+            "buy": numpy.array(buy, dtype=bool),
+            "intraday": numpy.array(intraday, dtype=bool),
+            "date": numpy.array(date, dtype=numpy.int64)
+        }
+
+        return (sorted(codes, key=codes.get), columns)
+
+    @stage("TradeDatabase.append")
+    def append(self, entries, misc_total):
+        """ Add transactions, and set the misc charges total
+        """
+        self.db.executemany("INSERT INTO transactions ({}) VALUES ({})".format(self.FIELDS, ",".join("?" * 11)),
+                            itertools.imap(self.row, entries))
+        self.state["misc_total"] = misc_total
+
+
+@stage()
+def crunch_transactions(entries):
+    """ Crunch transactions
+    """
+    global ipo_investment
+
+    crunched_entries = []
+
+    misc_total = 0
+
+    for entry in entries:
+        if entry.type == MISC_KEY:
+            misc_total += entry.to_dict()["Total"]
+        else:
+            entry.drop('STT')
+
+            if entry.scrip is None:
+                entry.scrip = Transaction.share(scrip_manager.get_scrip_from_title(entry.extra('Security')))
+
+            crunched_entries.append(entry)
+
+        # IPOs
+        if entry.extra("Notes") == "IPO":
+            ipo_investment += entry.total
+
+    crunched_entries = sorted(crunched_entries, key=transaction_key)
+
+    crunched_entries.append(Transaction.from_dict({"Type": MISC_KEY, "Total": misc_total}))
+
+    return crunched_entries
+
+
+def calculate_profit(buy_value, sell_value):
+    """ Calculate profit for a trade
+    """
+    profit = sell_value - buy_value
+    profit_percentage = profit / buy_value * 100
+
+    return (profit, profit_percentage)
+
+
+@stage()
+def crunch_trades(transactions, trades=None):
+    """ Crunch trades
+
+    Raw trades from an earlier run can be passed in to apply the
+    transactions on top of them. They are updated in place.
+    """
+    if trades is None:
+        trades = {}
+
+    # Retreive and clean MISC
+    misc_total = transactions[-1].to_dict()["Total"]
+    del(transactions[-1])
+
+    trades[MISC_KEY] = {
+            "Total Value": misc_total
+            }
+
+    for transaction in transactions:
+        scrip = transaction.scrip
+        quantity = transaction.quantity
+        total = transaction.total
+
+        # Blank entry
         if scrip not in trades:
             trades[scrip] = {
                 "Total Quantity": 0,
@@ -477,107 +2671,620 @@ def crunch_trades(transactions):
                 "Total Brokerage": 0
             }
 
-        # BUY
-        if transaction['Type'] == 'BUY':
-            # If intraday, just add to total intraday values
-            if 'Intraday' in transaction and transaction['Intraday']:
-                trades[scrip]['Intraday Buy Value'] += total
+        # If intraday, just add to total intraday values
+        if transaction.intraday:
+            if transaction.type == 'BUY':
+                trades[scrip]['Intraday Buy Value'] += total
+            else:
+                trades[scrip]['Intraday Sell Value'] += total
+        else:
+            apply_delivery(trades[scrip], transaction.type == 'BUY', quantity, total)
+
+        trades[scrip]['Total Trade Volume'] += total
+
+        trades[scrip]['Total Brokerage'] += transaction.brokerage * quantity
+
+        # Prune
+        if (trades[scrip]['Total Quantity'] == 0 and
+                trades[scrip]['Short Quantity'] == 0 and
+                trades[scrip]['Intraday Buy Value'] == 0 and
+                trades[scrip]['Intraday Sell Value'] == 0 and
+                trades[scrip]['Total Buy Value'] == 0):
+            raise Exception('Boo')
+            del(trades[scrip])
+
+    return finish_trades(trades)
+
+
+def apply_delivery(trade, is_buy, quantity, total):
+    """ Apply a delivery buy or sell to the average-cost position of a
+    scrip, in the raw trade
+    """
+    # BUY
+    if is_buy:
+        if trade['Short Quantity'] == 0:
+            trade['Total Quantity'] += quantity
+            trade['Total Value'] += total
+            trade['Rate'] = trade['Total Value'] / trade['Total Quantity']
+        else:
+            # Cover short
+            if trade['Short Quantity'] >= quantity:
+                # Not enough to cover all
+                trade['Total Buy Value'] += total
+                trade['Total Sell Value'] += (quantity * trade['Short Rate'])
+
+                trade['Short Quantity'] -= quantity
+                trade['Short Value'] = trade['Short Quantity'] * trade['Short Rate']
+            else:
+                # Cover short first
+                cover_quantity = trade['Short Quantity']
+
+                trade['Total Buy Value'] += (cover_quantity * total / quantity)
+                trade['Total Sell Value'] += (cover_quantity * trade['Short Rate'])
+
+                trade['Short Quantity'] = 0
+                trade['Short Value'] = 0
+
+                # Add rest to stock
+                buy_quantity = quantity - cover_quantity
+                trade['Total Quantity'] += buy_quantity
+                trade['Total Value'] += (buy_quantity * total / quantity)
+                trade['Rate'] = trade['Total Value'] / trade['Total Quantity']
+    else:
+        # Have shares?
+        if trade['Total Quantity'] >= quantity:
+            # Calculate cleared value
+            trade['Total Buy Value'] += quantity * trade['Rate']
+            trade['Total Sell Value'] += total
+
+            # The difference is the profit/loss. Rate remains the same.
+            trade['Total Quantity'] -= quantity
+            trade['Total Value'] = trade['Total Quantity'] * trade['Rate']
+        elif trade['Total Quantity'] == 0:
+            trade['Short Quantity'] += quantity
+            trade['Short Value'] += total
+            trade['Short Rate'] = trade['Short Value'] / trade['Short Quantity']
+        else:
+            # Partial short
+            cleared_quantity = trade['Total Quantity']
+
+            trade['Total Buy Value'] += trade['Total Value']
+            trade['Total Sell Value'] += (cleared_quantity * total / quantity)
+
+            trade['Total Quantity'] = 0
+            trade['Total Value'] = 0
+
+            trade['Short Quantity'] += quantity - cleared_quantity
+            trade['Short Value'] += total - (cleared_quantity * total / quantity)
+            trade['Short Rate'] = trade['Short Value'] / trade['Short Quantity']
+
+    # Clean
+    if trade['Total Quantity'] == 0:
+        trade['Rate'] = 0
+
+    if trade['Short Quantity'] == 0:
+        trade['Short Rate'] = 0
+
+
+def finish_trades(trades):
+    """ Cleared values and the pruned trades, from raw trades
+
+    The raw trades are updated in place with the cleared values.
+    """
+    # How much did we clear?
+    for k, v in trades.items():
+        if k == MISC_KEY:
+            continue
+
+        if v['Total Buy Value'] != 0:
+            v['Cleared'], v['Cleared Percentage'] = calculate_profit(v['Total Buy Value'], v['Total Sell Value'])
+
+        if v['Intraday Buy Value'] != 0:
+            v['Intraday Cleared'], v['Intraday Cleared Percentage'] = calculate_profit(v['Intraday Buy Value'], v['Intraday Sell Value'])
+
+    # Same insertion order as a full replay, so the report sums in the same order
+    ordered = {MISC_KEY: trades[MISC_KEY]}
+
+    for k in sorted(k for k in trades if k != MISC_KEY):
+        ordered[k] = trades[k]
+
+    # Prune again
+    trades = {k: v for k, v in ordered.iteritems() if k == MISC_KEY or trades[k]['Total Quantity'] > 0 or trades[k]['Cleared'] != 0 or trades[k]['Intraday Cleared'] != 0}
+
+    return trades
+
+
+def trade_columns(transactions):
+    """ Transactions as typed columns, with scrips coded by first appearance
+    """
+    scrip_codes = {}
+    scrip_column = map(attrgetter('scrip'), transactions)
+
+    for scrip in scrip_column:
+        if scrip not in scrip_codes:
+            scrip_codes[scrip] = len(scrip_codes)
+
+    scrips = sorted(scrip_codes, key=scrip_codes.get)
+
+    columns = {
+        "code": numpy.array(map(scrip_codes.__getitem__, scrip_column), dtype=numpy.intp),
+        "quantity": numpy.array(map(attrgetter('quantity'), transactions), dtype=numpy.float64),
+        "total": numpy.array(map(attrgetter('total'), transactions), dtype=numpy.float64),
+        "brokerage": numpy.array(map(attrgetter('brokerage'), transactions), dtype=numpy.float64),
+        "buy": numpy.array(map(attrgetter('type'), transactions), dtype=object) == 'BUY',
+        "intraday": numpy.array(map(bool, map(attrgetter('intraday'), transactions)), dtype=numpy.bool_),
+        "date": numpy.array([x if type(x) is int else 0 for x in map(attrgetter('date'), transactions)],
+                            dtype=numpy.int64)
+    }
+
+    return (scrips, columns)
+
+
+def crunch_trades_columnar(transactions, trades=None):
+    """ Crunch trades - same as crunch_trades, on columns
+
+    This is for whole histories: the raw trades passed in must be empty.
+    """
+    if numpy is None:
+        raise RuntimeError("The numpy trade engine needs numpy")
+
+    if trades is None:
+        trades = {}
+
+    # Retreive and clean MISC
+    misc_total = transactions[-1].to_dict()["Total"]
+    del(transactions[-1])
+
+    scrips, columns = trade_columns(transactions)
+
+    return crunch_columns(scrips, columns, misc_total, trades)
+
+
+@stage()
+def crunch_columns(scrips, columns, misc_total, trades, states=None):
+    """ Raw trades from transaction columns, and the pruned trades
+
+    Sums are grouped per scrip with bincount, which adds in transaction
+    order like crunch_trades does. Only the average cost is worked out
+    transaction by transaction, with apply_delivery like crunch_trades.
+
+    states, if given, has "held", "cost" and "cleared" lists as long as
+    the columns. They are set to the open quantity (short is negative), its
+    cost and the delivery profit cleared so far of the scrip after each
+    transaction.
+    """
+    trades[MISC_KEY] = {
+            "Total Value": misc_total
+            }
+
+    if not scrips:
+        return finish_trades(trades)
+
+    code = columns["code"]
+    total = columns["total"]
+    quantity = columns["quantity"]
+    buy = columns["buy"]
+    intraday = columns["intraday"]
+    groups = len(scrips)
+
+    # Grouped sums
+    trade_volume = numpy.bincount(code, total, groups)
+    brokerage = numpy.bincount(code, columns["brokerage"] * quantity, groups)
+    intraday_buy = numpy.bincount(code[intraday & buy], total[intraday & buy], groups)
+    intraday_sell = numpy.bincount(code[intraday & ~buy], total[intraday & ~buy], groups)
+
+    # Transactions of each scrip, in order
+    order = numpy.argsort(code, kind='mergesort').tolist()
+    ends = numpy.cumsum(numpy.bincount(code, minlength=groups)).tolist()
+
+    quantity = quantity.tolist()
+    total = total.tolist()
+    buy = buy.tolist()
+    intraday = intraday.tolist()
+
+    if states is not None:
+        held = states["held"]
+        cost = states["cost"]
+        cleared = states["cleared"]
+
+    start = 0
+
+    for group, scrip in enumerate(scrips):
+        trade = {
+            "Total Quantity": 0,
+            "Total Value": 0,
+            "Rate": 0,
+            "Cleared": 0,
+            "Cleared Percentage": 0,
+            "Intraday Cleared": 0,
+            "Intraday Cleared Percentage": 0,
+            "Total Buy Value": 0,
+            "Total Sell Value": 0,
+            "Short Quantity": 0,
+            "Short Value": 0,
+            "Short Rate": 0,
+            "Intraday Buy Value": float(intraday_buy[group]),
+            "Intraday Sell Value": float(intraday_sell[group]),
+            "Total Trade Volume": float(trade_volume[group]),
+            "Total Brokerage": float(brokerage[group])
+        }
+
+        has_intraday = False
+
+        for i in order[start:ends[group]]:
+            if intraday[i]:
+                has_intraday = has_intraday or total[i] != 0
+            else:
+                apply_delivery(trade, buy[i], quantity[i], total[i])
+
+            if (trade["Total Quantity"] == 0 and trade["Short Quantity"] == 0 and
+                    not has_intraday and trade["Total Buy Value"] == 0):
+                raise Exception('Boo')
+
+            if states is not None:
+                held[i] = trade["Total Quantity"] - trade["Short Quantity"]
+                cost[i] = trade["Total Value"] - trade["Short Value"]
+                cleared[i] = trade["Total Sell Value"] - trade["Total Buy Value"]
+
+        start = ends[group]
+
+        trades[scrip] = trade
+
+    return finish_trades(trades)
+
+
+TRADE_ENGINES = {
+    "python": crunch_trades,
+    "numpy": crunch_trades_columnar
+}
+
+
+def load_positions():
+    """ Position snapshot from the last run, or None
+    """
+    try:
+        with open(POSITIONS_FILE) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def save_positions(positions):
+    dump_json_atomic(positions, POSITIONS_FILE, indent=2, sort_keys=True)
+
+
+@stage()
+def rebuild_positions(store, engine=None):
+    """ Position snapshot from the whole trade history
+    """
+    positions = {
+        "count": store.count,
+        "last": store.last_stamps(),
+        "trades": {}
+    }
+
+    if (engine or TRADE_ENGINE) == "numpy":
+        scrips, columns = store.columns()
+        trades = crunch_columns(scrips, columns, store.misc_total, positions["trades"])
+    else:
+        transactions = store.transactions(extras=False)
+        transactions.append(store.misc_entry())
+
+        trades = crunch_trades(transactions, positions["trades"])
+
+    return (positions, trades)
+
+
+@stage()
+def update_positions(positions, store, new_entries):
+    """ Apply only the new transactions on top of the position snapshot
+
+    The store has the history including new_entries. A scrip that gets a
+    transaction older than what the snapshot has absorbed is replayed from
+    the history.
+    """
+    last = positions["last"]
+
+    new_entries = sorted([entry for entry in new_entries if entry.type != MISC_KEY],
+                         key=transaction_key)
+
+    replay = set(entry.scrip for entry in new_entries
+                 if entry.scrip in last and
+                 transaction_key(entry)[1:] < tuple(last[entry.scrip]))
+
+    for scrip in replay:
+        del(positions["trades"][scrip])
+
+    batch = store.transactions(replay, extras=False)
+    batch += [entry for entry in new_entries if entry.scrip not in replay]
+
+    for entry in batch:
+        last[entry.scrip] = transaction_key(entry)[1:]
+
+    positions["count"] = store.count
+
+    # Misc charges are totalled over the whole history already
+    batch.append(store.misc_entry())
+
+    return crunch_trades(batch, positions["trades"])
+
+
+def compare_positions(positions, rebuilt):
+    """ Differences between the incremental snapshot and a full rebuild
+    """
+    differences = []
+    trades = positions["trades"]
+
+    for scrip in sorted(set(trades) | set(rebuilt["trades"])):
+        old = trades.get(scrip, {})
+        new = rebuilt["trades"].get(scrip, {})
+
+        for key in sorted(set(old) | set(new)):
+            if old.get(key) != new.get(key):
+                differences.append("{} {}: {} != {}".format(scrip, key, old.get(key), new.get(key)))
+
+    return differences
+
+
+def day_numbers(dates):
+    """ Days since the epoch of dates like 20160123
+    """
+    months = (dates // 10000 - 1970).astype('M8[Y]').astype('M8[M]') + (dates // 100 % 100 - 1).astype('m8[M]')
+
+    return (months.astype('M8[D]') + (dates % 100 - 1).astype('m8[D]')).astype(numpy.int64)
+
+
+def load_price_history(filename):
+    """ Closing prices of each scrip - {scrip: (days, closes)}, days since
+    the epoch in order - from CSV with scrip, date (YYYY-MM-DD) and close
+    columns
+    """
+    series = {}
+
+    with open(filename) as f:
+        for row in csv.DictReader(f):
+            series.setdefault(row["scrip"], {})[row["date"]] = float(row["close"])
+
+    prices = {}
+
+    for scrip, closes in series.items():
+        dates = sorted(closes)
+        prices[scrip] = (numpy.array(dates, dtype='M8[D]').astype(numpy.int64),
+                         numpy.array(map(closes.__getitem__, dates)))
+
+    return prices
+
+
+VALUATION_KEYS = ["value", "invested", "realized", "unrealized"]
+
+
+@stage()
+def valuate(scrips, columns, prices, last_day=None):
+    """ Daily value of the portfolio from the first trade to last_day
+
+    scrips and columns are as crunch_columns has them (with a date column),
+    and prices as load_price_history has them. Days are days since the
+    epoch; last_day is the last trade or price by default.
+
+    Returns a day array, and value, invested (average cost of what is
+    held), realized (profit cleared, intraday too) and unrealized arrays
+    for those days. A holding is valued at its last close on or before the
+    day, or at cost before it has one. Charges and dividends are left out.
+
+    The average cost comes out of one crunch_columns pass. The days are
+    filled per scrip with searches and cumulative sums, not a replay for
+    each day.
+    """
+    if numpy is None:
+        raise RuntimeError("Valuation needs numpy")
+
+    if not scrips:
+        valuation = {key: numpy.zeros(0) for key in VALUATION_KEYS}
+        valuation["day"] = numpy.zeros(0, dtype=numpy.int64)
+
+        return valuation
+
+    code = columns["code"]
+    count = len(code)
+
+    states = {"held": [0.0] * count, "cost": [0.0] * count, "cleared": [0.0] * count}
+    crunch_columns(scrips, columns, 0, {}, states)
+
+    held = numpy.array(states["held"])
+    cost = numpy.array(states["cost"])
+    cleared = numpy.array(states["cleared"])
+
+    # Intraday profit, as it comes in
+    total = columns["total"]
+    flow = numpy.where(columns["intraday"], numpy.where(columns["buy"], -total, total), 0.0)
+
+    # Trades without a date count from the first day
+    dates = columns["date"]
+    dated = (dates >= 10000101) & (dates <= 99991231)
+    days = numpy.zeros(count, dtype=numpy.int64)
+    days[dated] = day_numbers(dates[dated])
+
+    first = days[dated].min() if dated.any() else int(time.time() // 86400)
+    days[~dated] = first
+
+    if last_day is None:
+        last_day = max([days.max()] + [prices[scrip][0][-1] for scrip in scrips
+                                       if scrip in prices and len(prices[scrip][0])])
+
+    calendar = numpy.arange(first, max(last_day, first) + 1, dtype=numpy.int64)
+
+    value = numpy.zeros(len(calendar))
+    invested = numpy.zeros(len(calendar))
+    realized = numpy.zeros(len(calendar))
+
+    # Transactions of each scrip, in order
+    order = numpy.argsort(code, kind='mergesort')
+    ends = numpy.cumsum(numpy.bincount(code, minlength=len(scrips))).tolist()
+
+    start = 0
+
+    for group, scrip in enumerate(scrips):
+        rows = order[start:ends[group]]
+        start = ends[group]
+
+        if not len(rows):
+            continue
+
+        # Last transaction of the scrip on or before each day
+        position = numpy.searchsorted(numpy.maximum.accumulate(days[rows]), calendar, 'right') - 1
+        traded = position >= 0
+        position = numpy.maximum(position, 0)
+        last = rows[position]
+
+        scrip_held = numpy.where(traded, held[last], 0.0)
+        scrip_cost = numpy.where(traded, cost[last], 0.0)
+
+        invested += scrip_cost
+        realized += numpy.where(traded, cleared[last] + numpy.cumsum(flow[rows])[position], 0.0)
+
+        price_days, closes = prices.get(scrip, ((), ()))
+
+        if len(price_days):
+            known = numpy.searchsorted(price_days, calendar, 'right') - 1
+            value += numpy.where(known >= 0, scrip_held * closes[numpy.maximum(known, 0)], scrip_cost)
+        else:
+            value += scrip_cost
+
+    return {
+        "day": calendar,
+        "value": value,
+        "invested": invested,
+        "realized": realized,
+        "unrealized": value - invested
+    }
+
+
+def save_valuation(valuation, filename):
+    """ Write the daily valuation as CSV
+    """
+    dates = valuation["day"].astype('M8[D]').astype(str).tolist()
+    columns = [valuation[key].tolist() for key in VALUATION_KEYS]
+
+    def write(f):
+        writer = csv.writer(f)
+        writer.writerow(["date"] + VALUATION_KEYS)
+
+        for row in zip(dates, *columns):
+            writer.writerow([row[0]] + ["{:.2f}".format(x) for x in row[1:]])
+
+    write_atomic(filename, write)
+
+
+def date_ordinal(date, ordinals={}):
+    """ Day number of a date like 20160123, or None for one that is not
+    """
+    if date not in ordinals:
+        try:
+            ordinals[date] = datetime.date(date // 10000, date // 100 % 100, date % 100).toordinal()
+        except (TypeError, ValueError):
+            ordinals[date] = None
+
+    return ordinals[date]
+
+
+@stage()
+def match_lots(transactions):
+    """ FIFO tax lots of the delivery trades, in transaction_key order
+
+    Each scrip has a deque of open lots - [day, date, quantity, rate,
+    side] - all bought (side 1) or all sold short (side -1). A trade of
+    the other side closes them oldest first, and what is left of it opens
+    a lot. Each lot is touched once when it opens and once when it closes.
+
+    Returns the open lots of each scrip and the closed lots, as (scrip,
+    opened, closed, quantity, buy value, sell value, days held) - days is
+    None when a date is missing.
+    """
+    lots = {}
+    closed = []
+    close = closed.append
+
+    for transaction in transactions:
+        quantity = transaction.quantity
+
+        if transaction.intraday or not quantity:
+            continue
+
+        scrip = transaction.scrip
+        rate = transaction.total / quantity
+        side = 1 if transaction.type == 'BUY' else -1
+        date = transaction.date
+        day = date_ordinal(date)
+
+        queue = lots.get(scrip)
+
+        if queue is None:
+            queue = lots[scrip] = deque()
+
+        while quantity and queue and queue[0][4] != side:
+            lot = queue[0]
+            lot_quantity = lot[2]
+            matched = quantity if quantity < lot_quantity else lot_quantity
+            days = day - lot[0] if day is not None and lot[0] is not None else None
+
+            if side < 0:
+                close((scrip, lot[1], date, matched, matched * lot[3], matched * rate, days))
             else:
-                if trades[scrip]['Short Quantity'] == 0:
-                    trades[scrip]['Total Quantity'] += quantity
-                    trades[scrip]['Total Value'] += total
-                    trades[scrip]['Rate'] = trades[scrip]['Total Value'] / trades[scrip]['Total Quantity']
-                else:
-                    # Cover short
-                    if trades[scrip]['Short Quantity'] >= quantity:
-                        # Not enough to cover all
-                        trades[scrip]['Total Buy Value'] += total
-                        trades[scrip]['Total Sell Value'] += (quantity * trades[scrip]['Short Rate'])
-
-                        trades[scrip]['Short Quantity'] -= quantity
-                        trades[scrip]['Short Value'] = trades[scrip]['Short Quantity'] * trades[scrip]['Short Rate']
-                    else:
-                        # Cover short first
-                        cover_quantity = trades[scrip]['Short Quantity']
-
-                        trades[scrip]['Total Buy Value'] += (cover_quantity * total / quantity)
-                        trades[scrip]['Total Sell Value'] += (cover_quantity * trades[scrip]['Short Rate'])
-
-                        trades[scrip]['Short Quantity'] = 0
-                        trades[scrip]['Short Value'] = 0
-
-                        # Add rest to stock
-                        buy_quantity = quantity - cover_quantity
-                        trades[scrip]['Total Quantity'] += buy_quantity
-                        trades[scrip]['Total Value'] += (buy_quantity * total / quantity)
-                        trades[scrip]['Rate'] = trades[scrip]['Total Value'] / trades[scrip]['Total Quantity']
-        else:
-            # If intraday, just add to total intraday values
-            if 'Intraday' in transaction and transaction['Intraday']:
-                trades[scrip]['Intraday Sell Value'] += total
+                close((scrip, lot[1], date, matched, matched * rate, matched * lot[3], days))
+
+            if matched == lot_quantity:
+                queue.popleft()
             else:
-                # Have shares?
-                if trades[scrip]['Total Quantity'] >= quantity:
-                    # Calculate cleared value
-                    trades[scrip]['Total Buy Value'] += quantity * trades[scrip]['Rate']
-                    trades[scrip]['Total Sell Value'] += total
-
-                    # The difference is the profit/loss. Rate remains the same.
-                    trades[scrip]['Total Quantity'] -= quantity
-                    trades[scrip]['Total Value'] = trades[scrip]['Total Quantity'] * trades[scrip]['Rate']
-                elif trades[scrip]['Total Quantity'] == 0:
-                    trades[scrip]['Short Quantity'] += quantity
-                    trades[scrip]['Short Value'] += total
-                    trades[scrip]['Short Rate'] = trades[scrip]['Short Value'] / trades[scrip]['Short Quantity']
-                else:
-                    # Partial short
-                    cleared_quantity = trades[scrip]['Total Quantity']
+                lot[2] = lot_quantity - matched
 
-                    trades[scrip]['Total Buy Value'] += trades[scrip]['Total Value']
-                    trades[scrip]['Total Sell Value'] += (cleared_quantity * total / quantity)
+            quantity -= matched
 
-                    trades[scrip]['Total Quantity'] = 0
-                    trades[scrip]['Total Value'] = 0
+        if quantity:
+            queue.append([day, date, quantity, rate, side])
 
-                    trades[scrip]['Short Quantity'] += quantity - cleared_quantity
-                    trades[scrip]['Short Value'] += total - (cleared_quantity * total / quantity)
-                    trades[scrip]['Short Rate'] = trades[scrip]['Short Value'] / trades[scrip]['Short Quantity']
+    return (lots, closed)
 
-        trades[scrip]['Total Trade Volume'] += total
 
-        trades[scrip]['Total Brokerage'] += float(transaction["Brokerage"]) * quantity
+def tax_split(closed):
+    """ Short and long term gains of closed lots
+    """
+    short_term = 0
+    long_term = 0
 
-        # Prune
-        if (trades[scrip]['Total Quantity'] == 0 and
-                trades[scrip]['Short Quantity'] == 0 and
-                trades[scrip]['Intraday Buy Value'] == 0 and
-                trades[scrip]['Intraday Sell Value'] == 0 and
-                trades[scrip]['Total Buy Value'] == 0):
-            raise Exception('Boo')
-            del(trades[scrip])
+    for lot in closed:
+        if lot[6] is not None and lot[6] > LONG_TERM_DAYS:
+            long_term += lot[5] - lot[4]
+        else:
+            short_term += lot[5] - lot[4]
 
-        # Clean
-        if trades[scrip]['Total Quantity'] == 0:
-            trades[scrip]['Rate'] = 0
+    return {"short_term_gain": short_term, "long_term_gain": long_term}
 
-        if trades[scrip]['Short Quantity'] == 0:
-            trades[scrip]['Short Rate'] = 0
 
-    # How much did we clear?
-    for k, v in trades.items():
-        if k == MISC_KEY:
-            continue
+def save_lots(closed, filename):
+    """ Write the closed lots and their gains as CSV
+    """
+    def write(f):
+        writer = csv.writer(f)
+        writer.writerow(["scrip", "opened", "closed", "quantity", "buy_value", "sell_value", "gain", "days", "term"])
 
-        if v['Total Buy Value'] != 0:
-            v['Cleared'], v['Cleared Percentage'] = calculate_profit(v['Total Buy Value'], v['Total Sell Value'])
+        for scrip, opened, closed_on, quantity, buy_value, sell_value, days in closed:
+            writer.writerow([scrip, opened, closed_on, quantity, "{:.2f}".format(buy_value),
+                             "{:.2f}".format(sell_value), "{:.2f}".format(sell_value - buy_value), days,
+                             "long" if days is not None and days > LONG_TERM_DAYS else "short"])
 
-        if v['Intraday Buy Value'] != 0:
-            v['Intraday Cleared'], v['Intraday Cleared Percentage'] = calculate_profit(v['Intraday Buy Value'], v['Intraday Sell Value'])
+    write_atomic(filename, write)
 
-    # Prune again
-    trades = {k: v for k, v in trades.iteritems() if k == MISC_KEY or trades[k]['Total Quantity'] > 0 or trades[k]['Cleared'] != 0 or trades[k]['Intraday Cleared'] != 0}
 
-    return trades
+def update_tax_lots(store, filename):
+    """ Match the whole trade history into FIFO lots, for the report's tax,
+    and write the closed lots to filename
+    """
+    global tax_gains
+
+    lots, closed = match_lots(store.transactions(extras=False))
+
+    tax_gains = tax_split(closed)
+    save_lots(closed, filename)
 
 
 def update_portfolio(trades, portfolio):
@@ -604,6 +3311,161 @@ def update_portfolio(trades, portfolio):
     portfolio[MISC_KEY] = {"Total Value": trades[MISC_KEY]["Total Value"]}
 
 
+# Totals of the report - title, report key(s), colour(s)
+REPORT_TOTALS = [
+        ["A. TOTAL INVESTMENT", 'total', 'white'],
+        ["B. CURRENT VALUE", 'current_value', 'yellow'],
+        ["C. CHARGES (ACTUAL)", 'charges', 'cyan'],
+        ["C1. ANNUAL CHARGES", 'charges_annual', 'cyan'],
+        ["C2. LATE PAYMENT CHARGES", 'charges_late', 'cyan'],
+        ["C3. CHARGES REFUND", 'charges_credit', 'cyan'],
+        ["C4. SERVICE TAX", 'charges_st', 'cyan'],
+        ["D. EXIT LOAD (APPROX)", 'exit_load', 'cyan'],
+        ["E. PROFIT/LOSS [- EXIT LOAD]", ('profit', 'profit_percentage'), ("red", "green")],
+        ["F. CLEARED [- CHARGES]", 'cleared', ("red", "green")],
+        ["G. INTRADAY", 'intraday_cleared', ("red", "green")],
+        ["H. PREVIOUS BALANCE (ACTUAL)", 'previous_balance', ("red", "green")],
+        ["I. DIVIDEND", 'dividend', 'green'],
+        ["J. CAPITAL GAIN TAX (APPROX)", 'capital_gain_tax', 'cyan'],
+        ["J1. SHORT TERM GAIN (FIFO)", 'short_term_gain', ("red", "green")],
+        ["J2. LONG TERM GAIN (FIFO)", 'long_term_gain', ("red", "green")],
+        ["K. BALANCE (F + G + H + I - J)", 'balance', ("red", "green")],
+        ["L. TOTAL TRADE VOLUME", 'total_trade_volume', 'blue'],
+        ["M. TOTAL BROKERAGE", 'total_brokerage', 'blue'],
+        ["N. TOTAL IPO", 'ipo_investment', 'white'],
+        ["O. TOTAL FUNDS TRANSFERRED", 'total_funds_transferred', 'white'],
+        ["P. SO WHAT IS THE VERDICT??", ('verdict', 'verdict_percentage'), ("red", "green")]
+    ]
+
+
+class ReportHistory:
+    """ Totals and per-scrip rows of every report, by time
+
+    Runs are JSON lines in segment files. The index has where each run is
+    and when it was, so a run is found with a bisect and read with a seek.
+    A row is the values of ROW_KEYS, in that order.
+    """
+    ROW_KEYS = [x[3] for x in REPORT_FORMAT if x[3]]
+
+    def __init__(self, path=REPORT_HISTORY_DIR):
+        self.path = path
+        self.index_file = os.path.join(path, "index.json")
+
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except IOError:
+            self.index = {"segment": 0, "runs": []}
+
+        # [time, segment, offset, length] for each run, oldest first
+        self.runs = self.index["runs"]
+        self.times = [run[0] for run in self.runs]
+
+    def __len__(self):
+        return len(self.runs)
+
+    def segment_file(self, segment):
+        return os.path.join(self.path, "reports-{:05d}.jsonl".format(segment))
+
+    def read(self, position):
+        """ Run at index position - {"time", "totals", "rows"}
+        """
+        when, segment, offset, length = self.runs[position]
+
+        with open(self.segment_file(segment), 'rb') as f:
+            f.seek(offset)
+            run = json.loads(f.read(length))
+
+        # Byte strings, as the report has them
+        run["rows"] = {str(scrip): row for scrip, row in run["rows"].items()}
+        run["totals"] = {str(key): value.encode('utf-8') if isinstance(value, unicode) else value
+                         for key, value in run["totals"].items()}
+
+        return run
+
+    def ago(self, count):
+        """ Run count runs before the last (0 is the last), or None
+        """
+        if not 0 <= count < len(self.runs):
+            return None
+
+        return self.read(len(self.runs) - 1 - count)
+
+    def position(self, when):
+        """ Index of the last run at or before when (seconds since the
+        epoch), -1 if there is none
+        """
+        return bisect.bisect_right(self.times, when) - 1
+
+    def at(self, when):
+        """ Last run at or before when, or None
+        """
+        position = self.position(when)
+
+        return None if position < 0 else self.read(position)
+
+    def append(self, totals, portfolio, when=None):
+        when = time.time() if when is None else when
+
+        rows = {scrip: [value.get(key) for key in self.ROW_KEYS]
+                for scrip, value in portfolio.items() if scrip != MISC_KEY}
+        line = json.dumps({"time": when, "totals": totals, "rows": rows}, sort_keys=True)
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        # Next segment, when this one is full
+        segment = self.index["segment"]
+
+        if sum(1 for run in self.runs if run[1] == segment) >= REPORT_SEGMENT_RUNS:
+            segment += 1
+
+        with open(self.segment_file(segment), 'ab') as f:
+            # After anything a crash left behind
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(line + "\n")
+
+        self.runs.append([when, segment, offset, len(line)])
+        self.times.append(when)
+
+        # Drop the oldest segments
+        if segment != self.index["segment"]:
+            oldest = segment - REPORT_SEGMENTS + 1
+            dropped = sum(1 for run in self.runs if run[1] < oldest)
+
+            del(self.runs[:dropped])
+            del(self.times[:dropped])
+
+            for old in range(self.index["segment"] - REPORT_SEGMENTS + 1, oldest):
+                if os.path.exists(self.segment_file(old)):
+                    os.remove(self.segment_file(old))
+
+        self.index["segment"] = segment
+
+        dump_json_atomic(self.index, self.index_file)
+
+    @classmethod
+    def portfolio(cls, run):
+        """ The portfolio rows of a run, as process_portfolio left them
+        """
+        return {scrip: {key: value for key, value in zip(cls.ROW_KEYS, row) if value is not None}
+                for scrip, row in run["rows"].items()}
+
+
+def rotate_report_text(filename='report.txt'):
+    """ Move filename to filename.1 (and so on) once it is REPORT_TEXT_MAX big
+    """
+    if not os.path.exists(filename) or os.path.getsize(filename) < REPORT_TEXT_MAX:
+        return
+
+    for i in range(REPORT_TEXT_KEEP - 1, 0, -1):
+        if os.path.exists("{}.{}".format(filename, i)):
+            os.rename("{}.{}".format(filename, i), "{}.{}".format(filename, i + 1))
+
+    os.rename(filename, filename + ".1")
+
+
 def format_report_entry(source, title, value_key, color='blue', title_width=30, value_width=30, change_width=20, old_source=None):
     """ Format a line in report
     """
@@ -646,84 +3508,128 @@ def format_report_entry(source, title, value_key, color='blue', title_width=30,
     return entry
 
 
-def generate_report(transactions):
-    """ Create and update the portfolio
+@stage()
+def generate_report(transactions, delta_runs=1):
+    """ Create and update the portfolio, with changes against the report
+    delta_runs runs ago
     """
     print "Generating portfolio..."
 
+    history = ReportHistory()
+
     # Load last report
-    try:
-        with open('last_report.json') as f:
-            last_report = json.load(f)
-    except Exception:
-        last_report = None
+    last_report = history.ago(delta_runs - 1)
+
+    if last_report is not None:
+        last_report = last_report["totals"]
+    elif not history and delta_runs == 1:
+        # Before the history
+        try:
+            with open('last_report.json') as f:
+                last_report = json.load(f)
+        except Exception:
+            last_report = None
 
     portfolio = {}
 
-    update_portfolio(trades, portfolio)
+    update_portfolio(transactions, portfolio)
 
     report = process_portfolio(portfolio)
 
     # Store
-    json.dump(report, open('last_report.json', 'w'), indent=2, sort_keys=True)
-
-    final_report = [
-            ["A. TOTAL INVESTMENT", 'total', 'white'],
-            ["B. CURRENT VALUE", 'current_value', 'yellow'],
-            ["C. CHARGES (ACTUAL)", 'charges', 'cyan'],
-            ["C1. ANNUAL CHARGES", 'charges_annual', 'cyan'],
-            ["C2. LATE PAYMENT CHARGES", 'charges_late', 'cyan'],
-            ["C3. CHARGES REFUND", 'charges_credit', 'cyan'],
-            ["C4. SERVICE TAX", 'charges_st', 'cyan'],
-            ["D. EXIT LOAD (APPROX)", 'exit_load', 'cyan'],
-            ["E. PROFIT/LOSS [- EXIT LOAD]", ('profit', 'profit_percentage'), ("red", "green")],
-            ["F. CLEARED [- CHARGES]", 'cleared', ("red", "green")],
-            ["G. INTRADAY", 'intraday_cleared', ("red", "green")],
-            ["H. PREVIOUS BALANCE (ACTUAL)", 'previous_balance', ("red", "green")],
-            ["I. DIVIDEND", 'dividend', 'green'],
-            ["J. CAPITAL GAIN TAX (APPROX)", 'capital_gain_tax', 'cyan'],
-            ["K. BALANCE (F + G + H + I - J)", 'balance', ("red", "green")],
-            ["L. TOTAL TRADE VOLUME", 'total_trade_volume', 'blue'],
-            ["M. TOTAL BROKERAGE", 'total_brokerage', 'blue'],
-            ["N. TOTAL IPO", 'ipo_investment', 'white'],
-            ["O. TOTAL FUNDS TRANSFERRED", 'total_funds_transferred', 'white'],
-            ["P. SO WHAT IS THE VERDICT??", ('verdict', 'verdict_percentage'), ("red", "green")]
-        ]
+    now = time.time()
+    history.append(report, portfolio, now)
 
     # ------------ Display results --------------
+    text = "\n".join(format_report(report, portfolio, last_report, now)) + "\n"
+
     # ------------ Save results to file --------------
+    sys.stdout.write(text)
+
+    rotate_report_text()
 
     with open('report.txt', 'a') as outfile:
-        _saved_stdout = sys.stdout
-        sys.stdout = Writer(sys.stdout, outfile)
+        outfile.write(ANSI_CODES.sub("", text))
+
+
+def format_report(report, portfolio, last_report=None, when=None):
+    """ Lines of the report, with changes against last_report
+    """
+    when = datetime.datetime.now() if when is None else datetime.datetime.fromtimestamp(when)
+    lines = []
+
+    lines.append("")
+    lines.append("")
+    lines.append("+" * 80)
+    lines.append("-" * 30 + " " + colored(datetime.datetime.strftime(when, "%Y-%m-%d %H:%M:%S"), 'cyan') + " " + "-" * 29)
+    lines.append("+" * 80)
+
+    lines.extend(format_tabular(portfolio))
+
+    lines.append("=" * 80)
+
+    for report_item in REPORT_TOTALS:
+        # FIFO gains are only there with --tax-lots
+        if isinstance(report_item[1], basestring) and report_item[1] not in report:
+            continue
+
+        lines.append(format_report_entry(report, *report_item, title_width=30, value_width=28, old_source=last_report))
+
+    lines.append("=" * 80)
+
+    if report.get("unpriced"):
+        lines.append("NO PRICE - VALUED AT COST:")
+        lines.append(colored(report["unpriced"], 'yellow'))
+        lines.append("=" * 80)
+
+    if report["recommendation"]:
+        lines.append("RECOMMENDATIONS:")
+        lines.append(colored(report["recommendation"][:-1], 'green'))
+        lines.append("=" * 80)
+
+    lines.append("")
+    lines.append("+" * 80)
+    lines.append("")
+
+    return lines
 
-        print
-        print
-        print "+" * 80
-        print "-" * 30 + " " + colored(datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:%M:%S"), 'cyan') + " " + "-" * 29
-        print "+" * 80
 
-        print_tabular(portfolio)
+def show_past_report(when, delta_runs=None):
+    """ Print the last report at or before when (seconds since the epoch),
+    with changes against the one delta_runs runs before it
+    """
+    history = ReportHistory()
+    position = history.position(when)
+
+    if position < 0:
+        print "No report on or before " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(when))
+        return
 
-        print "=" * 80
+    run = history.read(position)
+    last_report = None
 
-        for report_item in final_report:
-            print format_report_entry(report, *report_item, title_width=30, value_width=28, old_source=last_report)
+    if delta_runs and position >= delta_runs:
+        last_report = history.read(position - delta_runs)["totals"]
 
-        print "=" * 80
+    portfolio = ReportHistory.portfolio(run)
 
-        if report["recommendation"]:
-            print "RECOMMENDATIONS:"
-            print colored(report["recommendation"][:-1], 'green')
-            print "=" * 80
+    sys.stdout.write("\n".join(format_report(run["totals"], portfolio, last_report, run["time"])) + "\n")
 
-        print
-        print "+" * 80
-        print
 
-        sys.stdout = _saved_stdout
+def parse_report_time(text):
+    """ Seconds since the epoch of "YYYY-MM-DD" (the end of that day) or
+    "YYYY-MM-DD HH:MM[:SS]", in local time
+    """
+    for layout, end in [("%Y-%m-%d %H:%M:%S", 0), ("%Y-%m-%d %H:%M", 59), ("%Y-%m-%d", 86399)]:
+        try:
+            return time.mktime(time.strptime(text, layout)) + end
+        except ValueError:
+            pass
+
+    raise ValueError("not a date: " + text)
 
 
+@stage()
 def process_portfolio(portfolio):
     """ Report from portfolio
     """
@@ -739,6 +3645,10 @@ def process_portfolio(portfolio):
     total_brokerage = 0
     total_dividend = 0
     recommendation = ""
+    unpriced = []
+
+    # Prices for what we hold, in one go
+    scrip_manager.load_prices([key for key in portfolio if key != MISC_KEY])
 
     # Final
     for key in dict(portfolio):
@@ -750,6 +3660,11 @@ def process_portfolio(portfolio):
             market_rate = scrip_manager.get_price(key)
 
             portfolio[key]["Market Rate"] = float(market_rate[0])
+
+            # Never had a price - value it at cost
+            if not scrip_manager.has_price(key) and portfolio[key]["Total Quantity"] > 0:
+                portfolio[key]["Market Rate"] = portfolio[key]["Total Value"] / portfolio[key]["Total Quantity"]
+                unpriced.append(scrip_manager.get_title_from_scrip(key))
             portfolio[key]["Market Change"] = market_rate[1]
 
             portfolio[key]["Dividend"] = get_dividend(key)
@@ -802,7 +3717,13 @@ def process_portfolio(portfolio):
     charges -= charges_credit
 
     cleared -= charges
-    capital_gain_tax = (cleared + intraday_cleared) * CAPITAL_GAIN_TAX_RATE
+
+    if tax_gains is None:
+        capital_gain_tax = (cleared + intraday_cleared) * CAPITAL_GAIN_TAX_RATE
+    else:
+        # Charges and intraday go with the short term gains
+        capital_gain_tax = ((tax_gains["short_term_gain"] - charges + intraday_cleared) * CAPITAL_GAIN_TAX_RATE +
+                            tax_gains["long_term_gain"] * LONG_TERM_TAX_RATE)
     exit_load = (current_value * EXIT_LOAD_RATE)
     profit -= exit_load
     previous_balance = PREVIOUS_BALANCE
@@ -811,7 +3732,7 @@ def process_portfolio(portfolio):
     verdict = balance + profit
     verdict_percentage = verdict / total_transferred * 100
 
-    return {
+    report = {
                 "total": total,
                 "current_value": current_value,
                 "total_funds_transferred": total_transferred,
@@ -834,20 +3755,21 @@ def process_portfolio(portfolio):
                 "total_brokerage": total_brokerage,
                 "verdict": verdict,
                 "verdict_percentage": verdict_percentage,
-                "recommendation": recommendation
+                "recommendation": recommendation,
+                "unpriced": ", ".join(sorted(unpriced)).encode('utf-8')
             }
 
+    if tax_gains is not None:
+        report.update(tax_gains)
+
+    return report
 
-def print_tabular(data):
-    """ Display the portfolio in tabular form
-    """
-    data_table = convert_to_table(data)
 
-    print
-    print
-    print_table(data_table)
-    print
-    print
+@stage()
+def format_tabular(data):
+    """ Lines of the portfolio in tabular form
+    """
+    return ["", ""] + format_table(convert_to_table(data)) + ["", ""]
 
 
 def convert_to_table(data):
@@ -939,17 +3861,25 @@ def format_table_entry(value, color, width, alignment, is_number=True, is_curren
     return entry
 
 
-def print_table(data_table):
-    """ Print the two dimentional list as a table
+def format_table(data_table):
+    """ Lines of the two dimentional list as a table
     """
-    for i, entry in enumerate(data_table[0]):
-        print "+ {0:-^{width}}".format("", width=REPORT_FORMAT[i][1]),
+    borders = {}
+
+    def border(count):
+        if count not in borders:
+            borders[count] = " ".join("+ {0:-^{width}}".format("", width=REPORT_FORMAT[i][1])
+                                      for i in range(count)) + " +"
 
-    print "+"
+        return borders[count]
+
+    lines = [border(len(data_table[0]))]
 
     is_first = True
 
     for line in data_table:
+        cells = []
+
         for i, entry in enumerate(line):
 
             color = REPORT_FORMAT[i][6]
@@ -959,43 +3889,60 @@ def print_table(data_table):
             is_currency = REPORT_FORMAT[i][5]
 
             if is_first:
-                print "| {0:^{width}}".format(entry, width=width),
+                cells.append("| {0:^{width}}".format(entry, width=width))
             else:
-                print format_table_entry(entry, color, width, alignment, is_number, is_currency),
+                cells.append(format_table_entry(entry, color, width, alignment, is_number, is_currency))
 
-        print "|"
-
-        for i, entry in enumerate(line):
-            print "+ {0:-^{width}}".format("", width=REPORT_FORMAT[i][1]),
-
-        print "+"
+        lines.append(" ".join(cells) + " |")
+        lines.append(border(len(line)))
 
         is_first = False
 
+    return lines
+
 
 def get_dividend(key):
     """ Get dividend earned for scrip
     """
     global dividends
 
-    entries = [x for x in dividends if x['Scrip'] == key]
-
-    return sum(float(item["Total"]) for item in entries)
+    return dividends.total(key)
 
 
+@stage()
 def get_ledger_totals():
     """ Get the total amounts from Ledger
     """
-    ledgers = []
     ledger_totals = {}
 
-    # Parse Ledger files
+    try:
+        with open(LEDGER_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {"files": {}, "amounts": {}}
+
+    ledger_files = ProcessedIndex(cache)
+    amounts = {}
+    ledgers = []
+
+    # Parse Ledger files - only the ones we have not seen
     for filename in glob.glob('Ledger*.htm*'):
-        if filename not in processed_files:
-            ledger = parse_ledger_file(filename)
-            ledgers.extend(ledger)
+        digest = ledger_files.digest(filename)
+
+        if digest not in cache["amounts"]:
+            cache["amounts"][digest] = ledger_amounts(parse_ledger_file(filename))
+
+        amounts[digest] = cache["amounts"][digest]
+        ledgers.append(amounts[digest])
 
-    ledger_totals = process_ledger_entries(ledgers)
+    # Forget files that are gone
+    files = {filename: info for filename, info in ledger_files.files.items()
+             if info["sha1"] in amounts}
+
+    dump_json_atomic({"files": files, "amounts": amounts}, LEDGER_CACHE_FILE,
+                     indent=2, sort_keys=True)
+
+    ledger_totals = sum_ledger_amounts(ledgers)
 
     return {
             "charges_annual": ledger_totals["Maintenance Charges"],
@@ -1006,6 +3953,7 @@ def get_ledger_totals():
     }
 
 
+@stage()
 def parse_ledger_file(filename):
     """ Get data from Ledger file
     """
@@ -1029,25 +3977,9 @@ def parse_ledger_file(filename):
     return entries
 
 
-def process_ledger_entries(entries):
-    """ Process transactions from Ledger
-    """
-    description_map = {
-        "To Bill": "Buy",
-        "OPENING BALANCE": "Opening Balance",
-        "Direct Credit": "Transfer",
-        "Bank Payment": "Withdrawal",
-        "By Bill": "Sell",
-        "Amc": "Maintenance Charges",
-        "Delayed": "Late Charges",
-        "Dividend": "Dividend",
-        "Reversed": "Charges Reversed",
-        "Refunded": "Charges Reversed",
-        "Service Tax": "Service Tax",
-        "Stt For": "Service Tax",
-        "Fund Transfer For Offsetting": "Ignore"
-    }
-
+def sum_ledger_amounts(ledgers):
+    """ Totals of ledger_amounts() for several Ledger files, in order
+    """
     totals = {
         "Buy": 0,
         "Opening Balance": 0,
@@ -1062,120 +3994,460 @@ def process_ledger_entries(entries):
         "Ignore": 0
     }
 
-    for entry in entries:
-        scrap_entries = ["Opening Balance"]
+    for amounts in ledgers:
+        for description, values in amounts.items():
+            for value in values:
+                totals[description] += value
+
+    return totals
 
+
+# Ledger description -> kind of amount. A description with several of them
+# is the first one in the order of this dict, as it always was.
+LEDGER_DESCRIPTION_MAP = {
+    "To Bill": "Buy",
+    "OPENING BALANCE": "Opening Balance",
+    "Direct Credit": "Transfer",
+    "Bank Payment": "Withdrawal",
+    "By Bill": "Sell",
+    "Amc": "Maintenance Charges",
+    "Delayed": "Late Charges",
+    "Dividend": "Dividend",
+    "Reversed": "Charges Reversed",
+    "Refunded": "Charges Reversed",
+    "Service Tax": "Service Tax",
+    "Stt For": "Service Tax",
+    "Fund Transfer For Offsetting": "Ignore"
+}
+LEDGER_DESCRIPTION_RANK = {key: i for i, key in enumerate(LEDGER_DESCRIPTION_MAP)}
+
+# Every description in the text, overlapping or not. Where one starts, no
+# other can, as none is a prefix of another.
+assert not [a for a in LEDGER_DESCRIPTION_MAP for b in LEDGER_DESCRIPTION_MAP
+            if a != b and b.startswith(a)]
+LEDGER_DESCRIPTIONS = re.compile("(?=({}))".format(
+    "|".join(re.escape(key) for key in LEDGER_DESCRIPTION_MAP)))
+
+LEDGER_SCRAP_ROWS = Keywords(["Opening Balance"])
+LEDGER_SCRAP_KEYS = Keywords(LEDGER_COLUMNS[1:4] + LEDGER_COLUMNS[-1:])
+LEDGER_KEYS = [key for key in LEDGER_COLUMNS if not LEDGER_SCRAP_KEYS.search(key)]
+
+
+def ledger_amounts(entries):
+    """ Amounts from Ledger rows as {description: [amount, ...]} in row order,
+    credit negative - adding them up in order gives the totals
+    """
+    amounts = {}
+
+    for entry in entries:
         # Scrap unnecessary entries
-        if any(item in "".join(entry) for item in scrap_entries):
+        if LEDGER_SCRAP_ROWS.search("".join(entry)):
             continue
 
         # Clean
         entry = [x.strip() for x in entry]
 
-        item = dict(zip(LEDGER_COLUMNS, entry))
+        item = {key: value for key, value in zip(LEDGER_COLUMNS, entry) if key in LEDGER_KEYS}
 
-        scrap_keys = LEDGER_COLUMNS[1:4]
-        scrap_keys.append(LEDGER_COLUMNS[-1])
+        found = sorted(LEDGER_DESCRIPTIONS.findall(item["Description"]), key=LEDGER_DESCRIPTION_RANK.get)
+        item["Description"] = [LEDGER_DESCRIPTION_MAP[key] for key in found][0]
 
-        item = {key:value for key,value in item.items() if not any(k in key for k in scrap_keys)}
+        values = amounts.setdefault(item["Description"], [])
 
-        item["Description"] = [value for key,value in description_map.items() if key in item["Description"]][0]
+        if item["Credit"]:
+            values.append(-float(item["Credit"]))
 
-        totals[item["Description"]] -= (float(item["Credit"]) if item["Credit"] else 0)
-        totals[item["Description"]] += (float(item["Debit"]) if item["Debit"] else 0)
+        if item["Debit"]:
+            values.append(float(item["Debit"]))
 
-    return totals
+    return amounts
 
 
-if __name__ == '__main__':
-    """ Main
+@stage()
+def load_state(storage):
+    """ Trade history, processed file index and dividends from storage
+    ("files" or "sqlite"), as (store, processed_files)
     """
-    # Setup scrips
-    scrip_manager = ScripManager()
-
-    transactions = []
-    processed_files = []
-    misc_trades = []
+    global dividends
+    global ipo_investment
 
-    file_list = [
-        "__trades.json",
-        "__processed.json",
-        "__dividends.json",
-    ]
     file_data = {}
+    migrate = False
+
+    if storage == "sqlite":
+        store = TradeDatabase()
+
+        # Set in the transaction that moves the rest in. Databases from before
+        # it was kept have trades.
+        migrate = not store.state.get("migrated", store.count > 0)
+    else:
+        store = TradeStore()
+
+        # A run that stopped while saving
+        move_state(store)
 
     # Load data from all files
-    for file_name in file_list:
-        try:
-            file_data[file_name] = json.load(open(file_name))
-        except Exception as e:
-            print e
-            file_data[file_name] = []
+    if storage == "files" or migrate:
+        for file_name in STATE_FILES:
+            try:
+                file_data[file_name] = json.load(open(file_name))
+            except Exception as e:
+                print e
+                file_data[file_name] = []
+
+        # Load dividend
+        for entry in file_data["__dividends.json"]:
+            if 'Scrip' not in entry:
+                print entry['Security']
+                entry['Scrip'] = scrip_manager.get_scrip_from_title(entry['Security'])
+
+    # Load existing transactions, processed file index and dividends
+    if storage == "sqlite":
+        if migrate:
+            print "Moving trades, dividends and processed files into " + TRADE_DATABASE + "..."
+
+            if os.path.exists(TRADE_STORE + ".meta.json"):
+                store.import_json(TradeStore().export())
+            elif os.path.exists("__trades.json"):
+                store.import_json(json.load(open("__trades.json")))
+
+            store.dividends.extend(file_data["__dividends.json"])
+
+            processed_files = store.processed_index(file_data["__processed.json"])
+            store.state["migrated"] = True
+        else:
+            processed_files = store.processed_index()
+
+        dividends = store.dividends
+    else:
+        if store.count == 0 and os.path.exists("__trades.json"):
+            print "Moving __trades.json into the trade store..."
+            store.import_json(json.load(open("__trades.json")))
+
+        processed_files = ProcessedIndex(file_data["__processed.json"])
+        dividends = DividendList(file_data["__dividends.json"])
 
-    # Load existing transactions
-    transactions = file_data["__trades.json"]
+    ipo_investment = store.ipo_investment()
 
-    # Load processed file list
-    processed_files = file_data["__processed.json"]
+    return (store, processed_files)
 
-    # Load dividend
-    dividends = file_data["__dividends.json"]
 
-    for entry in dividends:
-        if 'Scrip' not in entry:
-            print entry['Security']
-            entry['Scrip'] = scrip_manager.get_scrip_from_title(entry['Security'])
+@stage()
+def save_state(storage, store, processed_files):
+    """ Commit the new trades, with the dividends and processed files
+    """
+    if storage == "sqlite":
+        store.commit()
+        return
+
+    # The commit of the trade store decides whether these files are kept:
+    # written first, and moved in place once the trades are in
+    dump_json_atomic({
+        "count": store.count,
+        "__dividends.json": dividends.to_json(),
+        "__processed.json": processed_files.to_json()
+    }, STATE_PENDING)
+
+    store.commit()
+
+    move_state(store)
+
+
+def move_state(store):
+    """ Write the state files of a run the trade store committed, and drop
+    those of one it did not
+    """
+    if not os.path.exists(STATE_PENDING):
+        return
+
+    file_data = json.load(open(STATE_PENDING))
+
+    if file_data["count"] == store.count:
+        for file_name in STATE_FILES:
+            dump_json_atomic(file_data[file_name],
+                             file_name,
+                             indent=2,
+                             sort_keys=True)
+
+    os.remove(STATE_PENDING)
+
+
+def import_new_files(store, processed_files, jobs=1, parser=None):
+    """ Take in the Contract Notes, misc trades and dividends not seen
+    before. Returns the new transactions, added to the store - for
+    save_state to commit.
+    """
+    Transaction.forget()
+
+    # Misc charges so far, then the new transactions
+    transactions = [store.misc_entry()]
 
     # Parse 'Contract Note' HTML files
-    for filename in glob.glob('CN*.htm*'):
-        if filename not in processed_files:
-            cn_entries = crunch_cn_entries(process_cn_entries(parse_cn_file(filename)))
-            transactions.extend(cn_entries)
+    cn_files = processed_files.new_files(glob.glob('CN*.htm*'))
 
-            processed_files.append(filename)
+    for filename, cn_entries in import_cn_files(cn_files, jobs, parser):
+        transactions.extend(map(Transaction.from_dict, cn_entries))
+
+        processed_files.add(filename)
 
     # Parse MISC files
     for filename in glob.glob('misc_trades*.json'):
-        if filename not in processed_files:
+        if not processed_files.imported(filename):
             print "Processing file: " + filename + "..."
-            misc_trades = json.load(open(filename))
+            misc_trades = map(Transaction.from_dict, json.load(open(filename)))
             transactions.extend(misc_trades)
-            processed_files.append(filename)
+            processed_files.add(filename)
 
     # Parse DIVIDENT files
     for filename in glob.glob('dividend*.json'):
-        if filename not in processed_files:
+        if not processed_files.imported(filename):
             print "Processing file: " + filename + "..."
             dividend = json.load(open(filename))
-            dividends.extend(dividend)
 
-            for entry in dividends:
+            for entry in dividend:
                 if 'Scrip' not in entry:
                     entry['Scrip'] = scrip_manager.get_scrip_from_title(entry['Security'])
 
-            processed_files.append(filename)
+            dividends.extend(dividend)
+            processed_files.add(filename)
 
     # Standardize transactions
     transactions = crunch_transactions(transactions)
+    new_entries = transactions[:-1]
 
-    # CAUTION! transactions will be modified by crunch_trades()
     # NOTE! Save
-    file_data["__trades.json"] = list(transactions)
-    # Start eating them
-    trades = crunch_trades(transactions)
+    store.append(new_entries, transactions[-1].to_dict()["Total"])
+
+    return new_entries
+
+
+def load_trades(store, new_entries, history_count, engine=None, rebuild=False):
+    """ Positions and trades after new_entries - only crunching those, if
+    the snapshot on disk was taken at history_count transactions
+    """
+    positions = load_positions()
+
+    if positions is None or positions["count"] != history_count:
+        print "Rebuilding positions..."
+        positions, trades = rebuild_positions(store, engine)
+    elif rebuild:
+        trades = update_positions(positions, store, new_entries)
+        rebuilt, trades = rebuild_positions(store, engine)
+
+        differences = compare_positions(positions, rebuilt)
+
+        if differences:
+            print "Position snapshot differs from a full rebuild:"
+            print "\n".join(differences)
+        else:
+            print "Position snapshot matches a full rebuild."
+
+        positions = rebuilt
+    else:
+        trades = update_positions(positions, store, new_entries)
+
+    save_positions(positions)
+
+    return (positions, trades)
+
+
+def watched_files():
+    """ Size and mtime of the input files watch() looks at
+    """
+    files = {}
 
-    file_data["__dividends.json"] = list(dividends)
-    file_data["__processed.json"] = list(processed_files)
+    for pattern in WATCH_PATTERNS:
+        for filename in glob.glob(pattern):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+
+            files[filename] = (stat.st_size, stat.st_mtime)
+
+    return files
+
+
+def watch(args, store, processed_files, positions, trades):
+    """ Keep the state in memory, take in input files as they come and
+    refresh quotes every args.quote_interval seconds, regenerating the
+    report after each. Polls every args.interval seconds, until Ctrl-C.
+    """
+    seen = watched_files()
+    quoted = time.time()
+
+    print "Watching for new files every {}s...".format(args.interval)
+
+    while True:
+        time.sleep(args.interval)
+
+        files = watched_files()
+        changed = files != seen
+        quotes_due = time.time() - quoted >= args.quote_interval
+
+        if not changed and not quotes_due:
+            continue
+
+        seen = files
+        start = time.time()
 
-    # Save data to all files
-    for file_name in file_list:
         try:
-            json.dump(file_data[file_name],
-                      open(file_name, 'w'),
-                      indent=2,
-                      sort_keys=True)
+            if changed:
+                scrip_manager.load_titles()
+
+                new_entries = import_new_files(store, processed_files, args.jobs, args.parser)
+                trades = update_positions(positions, store, new_entries)
+
+                if args.tax_lots:
+                    update_tax_lots(store, args.tax_lots)
+
+                save_positions(positions)
+                save_state(args.storage, store, processed_files)
+
+            if quotes_due:
+                scrip_manager.refresh_prices()
+                quoted = time.time()
+
+            generate_report(trades, args.delta_runs)
         except Exception as e:
-            print e
+            # Start again from what is committed - the new files are imported
+            # again with the next change
+            print "Failed: {}: {} - reloading".format(type(e).__name__, e)
+
+            store.close()
+
+            store, processed_files = load_state(args.storage)
+            positions, trades = load_trades(store, [], store.count, args.engine)
+            continue
+
+        print "Report updated in {:.3f}s".format(time.time() - start)
+
+
+if __name__ == '__main__':
+    """ Main
+    """
+    parser = argparse.ArgumentParser(description="Track stocks")
+    parser.add_argument("--refresh", action="store_true",
+                        help="ignore cached quotes and fetch fresh ones")
+    parser.add_argument("--quotes", metavar="FILE",
+                        help="replay recorded quotes (JSON or CSV) instead of the feed")
+    parser.add_argument("--record-quotes", metavar="FILE",
+                        help="record the quotes used in this run for --quotes")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="parse contract notes in this many processes")
+    parser.add_argument("--parser", choices=sorted(CN_PARSERS), default=CN_PARSER,
+                        help="Contract Note parser")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="replay the whole trade history and check the position snapshot")
+    parser.add_argument("--export-trades", metavar="FILE",
+                        help="write the trade history as JSON, like __trades.json was")
+    parser.add_argument("--engine", choices=sorted(TRADE_ENGINES), default=TRADE_ENGINE,
+                        help="trade engine for whole-history replays")
+    parser.add_argument("--storage", choices=["files", "sqlite"], default=STORAGE,
+                        help="keep trades, dividends and processed files in files or in " + TRADE_DATABASE)
+    parser.add_argument("--profile", metavar="FILE",
+                        help="write the time, CPU time, calls and peak memory of each stage as JSON")
+    parser.add_argument("--cprofile", metavar="STAGE",
+                        help="also run STAGE under cProfile, into FILE.STAGE.prof (needs --profile)")
+    parser.add_argument("--delta-runs", type=int, default=1, metavar="N",
+                        help="show changes against the report N runs ago")
+    parser.add_argument("--as-of", metavar="DATE",
+                        help="show the last report on or before DATE (YYYY-MM-DD[ HH:MM[:SS]]) and exit")
+    parser.add_argument("--valuation", metavar="FILE",
+                        help="write the daily value and profit since the first trade as CSV (needs numpy)")
+    parser.add_argument("--price-history", metavar="FILE",
+                        help="daily closes for --valuation - CSV with scrip, date and close columns "
+                             "(instead of " + PRICE_DATABASE + ")")
+    parser.add_argument("--import-prices", metavar="FILE",
+                        help="add daily prices to " + PRICE_DATABASE + " - CSV with scrip, date, "
+                             "close and any of open, high, low and volume")
+    parser.add_argument("--tax-lots", metavar="FILE",
+                        help="match trades into FIFO lots for a short/long term capital gain tax, "
+                             "and write the closed lots as CSV")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running, and update the report when input files change")
+    parser.add_argument("--interval", type=float, default=WATCH_INTERVAL,
+                        help="seconds between looks at the input files, with --watch")
+    parser.add_argument("--quote-interval", type=float, default=QUOTE_CACHE_TTL,
+                        help="seconds between quote refreshes, with --watch")
+    args = parser.parse_args()
+
+    if args.cprofile and not args.profile:
+        parser.error("--cprofile needs --profile")
+
+    if args.delta_runs < 1:
+        parser.error("--delta-runs must be 1 or more")
+
+    if args.profile:
+        profiler.enable(args.cprofile)
+
+    if args.engine == "numpy" and numpy is None:
+        parser.error("the numpy engine needs numpy installed")
+
+    if args.valuation and numpy is None:
+        parser.error("--valuation needs numpy installed")
+
+    # Setup scrips
+    if args.quotes:
+        quote_provider = SnapshotQuoteProvider(args.quotes)
+    else:
+        quote_provider = GoogleQuoteProvider()
+
+    price_history = PriceHistory()
+
+    if args.import_prices:
+        print "Imported {} prices.".format(price_history.import_csv(args.import_prices))
+
+    scrip_manager = ScripManager(refresh=args.refresh, provider=quote_provider, prices=price_history)
+
+    if args.as_of:
+        try:
+            when = parse_report_time(args.as_of)
+        except ValueError as e:
+            parser.error(str(e))
+
+        show_past_report(when, args.delta_runs)
+
+        sys.exit(0)
+
+    store, processed_files = load_state(args.storage)
+    history_count = store.count
+
+    new_entries = import_new_files(store, processed_files, args.jobs, args.parser)
+
+    # Start eating them - only the new ones, if the snapshot is up to date
+    positions, trades = load_trades(store, new_entries, history_count, args.engine, args.rebuild)
+
+    save_state(args.storage, store, processed_files)
+
+    if args.export_trades:
+        dump_json_atomic(store.export(), args.export_trades, indent=2, sort_keys=True)
+
+    if args.tax_lots:
+        update_tax_lots(store, args.tax_lots)
+
+    if args.valuation:
+        scrips, columns = store.columns()
+        if args.price_history:
+            prices = load_price_history(args.price_history)
+        else:
+            prices = price_history.closes(scrips)
+        save_valuation(valuate(scrips, columns, prices), args.valuation)
 
     # Generate the porfolio
-    generate_report(trades)
+    generate_report(trades, args.delta_runs)
+
+    if args.record_quotes:
+        save_quote_snapshot(scrip_manager.get_quotes(), args.record_quotes)
+
+    for count, seconds in quote_provider.latencies:
+        print "Quotes: {} scrips in {:.3f}s".format(count, seconds)
+
+    if args.watch:
+        try:
+            watch(args, store, processed_files, positions, trades)
+        except KeyboardInterrupt:
+            print "Stopped watching."
+
+    if args.profile:
+        profiler.save(args.profile)